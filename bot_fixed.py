@@ -7,22 +7,64 @@ Premium Video Bot with Full Admin Panel
 
 import os
 import sys
+import asyncio
+import atexit
+import bisect
+import contextvars
+import functools
+import gzip
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
 import logging
-from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import logging.handlers
+import queue
+import random
+import re
+import signal
+import socket
+import string
+import time
+import threading
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit, parse_qsl
+import httpx
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+)
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
+    InlineQueryHandler,
     ContextTypes,
     MessageHandler,
     filters,
     CallbackQueryHandler,
+    ChatMemberHandler,
     ConversationHandler
 )
 from telegram.constants import ParseMode
-from telegram.error import BadRequest, TelegramError
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure, OperationFailure
+from telegram.helpers import escape_markdown
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import MongoClient, IndexModel, ReturnDocument, UpdateOne, ASCENDING, DESCENDING
+from pymongo.errors import ConnectionFailure, DuplicateKeyError, OperationFailure, PyMongoError
+
+try:
+    import brotli  # optional: smaller catalog responses for clients that accept br
+except ImportError:
+    brotli = None
 
 # ===================== CONFIGURATION =====================
 # All sensitive data from environment variables
@@ -49,17 +91,287 @@ except ValueError:
     print("❌ ERROR: ADMIN_ID must be a number!")
     sys.exit(1)
 
+# Max number of MongoDB calls running at the same time (worker threads)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "16"))
+
+# Seconds between reloads of cached settings/messages (picks up edits made by other workers)
+CONFIG_CACHE_TTL = int(os.getenv("CONFIG_CACHE_TTL", "30"))
+
+# Force-join membership cache: max entries and seconds to trust a joined / not-joined result
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "50000"))
+MEMBERSHIP_TTL = int(os.getenv("MEMBERSHIP_TTL", "300"))
+MEMBERSHIP_NEGATIVE_TTL = int(os.getenv("MEMBERSHIP_NEGATIVE_TTL", "20"))
+
+# Video lookup cache: max entries, seconds to keep a video and to remember an unknown code
+VIDEO_CACHE_SIZE = int(os.getenv("VIDEO_CACHE_SIZE", "20000"))
+VIDEO_CACHE_TTL = int(os.getenv("VIDEO_CACHE_TTL", "3600"))
+VIDEO_NEGATIVE_TTL = 60
+
+# Membership index: entries older than this many days are re-checked with Telegram
+MEMBERSHIP_INDEX_MAX_AGE_DAYS = int(os.getenv("MEMBERSHIP_INDEX_MAX_AGE_DAYS", "7"))
+
+# Set to 1 to run explain() on the hot queries at startup and log any collection scans
+CHECK_QUERY_PLANS = os.getenv("CHECK_QUERY_PLANS", "0") == "1"
+
+# View counters are written in batches: every N seconds or after M distinct videos
+VIEW_FLUSH_INTERVAL = int(os.getenv("VIEW_FLUSH_INTERVAL", "5"))
+VIEW_FLUSH_MAX = int(os.getenv("VIEW_FLUSH_MAX", "500"))
+
+# Views per video are also kept per hour and per day, for this many days
+VIEW_HOURLY_RETENTION_DAYS = 7
+VIEW_DAILY_RETENTION_DAYS = 90
+
+# Trending: a view counts half as much after this many hours; videos in the list
+TRENDING_HALF_LIFE_HOURS = float(os.getenv("TRENDING_HALF_LIFE_HOURS", "6"))
+TRENDING_SIZE = int(os.getenv("TRENDING_SIZE", "20"))
+TRENDING_TRACKED = 5000
+
+# "Watch next": videos a user watched within RECOMMEND_SESSION_HOURS count as watched
+# together; recommendations are rebuilt every RECOMMEND_REBUILD_INTERVAL seconds
+RECOMMEND_HISTORY = 5
+RECOMMEND_SESSION_HOURS = 6
+RECOMMEND_COUNT = 5
+RECOMMEND_REBUILD_INTERVAL = int(os.getenv("RECOMMEND_REBUILD_INTERVAL", "900"))
+RECOMMEND_RETENTION_DAYS = 90
+
+# User activity: skip users refreshed within this many seconds, batch the rest
+USER_REFRESH_WINDOW = int(os.getenv("USER_REFRESH_WINDOW", "300"))
+USER_FLUSH_INTERVAL = int(os.getenv("USER_FLUSH_INTERVAL", "5"))
+USER_FLUSH_MAX = int(os.getenv("USER_FLUSH_MAX", "500"))
+USER_RECENT_CACHE_SIZE = int(os.getenv("USER_RECENT_CACHE_SIZE", "100000"))
+
+# Repeated taps on the same video link: seconds after a delivery (or a "join first"
+# answer) during which the same request gets a short reply instead of running again
+VIDEO_REPEAT_WINDOW = int(os.getenv("VIDEO_REPEAT_WINDOW", "30"))
+FORCE_JOIN_REPEAT_WINDOW = 3
+
+# Seconds between re-counting users/videos to correct drift in the live counters
+STATS_RECONCILE_INTERVAL = int(os.getenv("STATS_RECONCILE_INTERVAL", "600"))
+STATS_DAYS_SHOWN = 7
+
+# Webhook mode: set WEBHOOK_URL (public https base URL) to serve updates over HTTP instead of polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip('/')
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+PORT = int(os.getenv("PORT", "8080"))
+
+# Multi-replica mode: set MULTI_REPLICA=1 to run several copies behind one WEBHOOK_URL.
+# Each replica needs a unique INSTANCE_ID (defaults to host name + pid). Cache changes
+# are passed between replicas through MongoDB, polled every EVENT_POLL_INTERVAL seconds
+MULTI_REPLICA = os.getenv("MULTI_REPLICA", "0") == "1"
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+EVENT_POLL_INTERVAL = float(os.getenv("EVENT_POLL_INTERVAL", "2"))
+EVENT_LOOKBACK_SECONDS = 30
+EVENT_RETENTION_SECONDS = 3600
+LEADER_LEASE_SECONDS = 30
+
+if MULTI_REPLICA and not WEBHOOK_URL:
+    print("❌ ERROR: MULTI_REPLICA needs WEBHOOK_URL (replicas cannot share polling)!")
+    sys.exit(1)
+
+# Unfinished admin edit flows (add channel, edit message...) are forgotten after this many seconds
+ADMIN_STATE_TTL = 3600
+
+# Mini App catalog API: set CATALOG_API=1 to serve GET /api/catalog on PORT (in polling
+# mode too); videos per page and the origin allowed to call it from a browser
+CATALOG_API = os.getenv("CATALOG_API", "0") == "1"
+CATALOG_PAGE_SIZE = int(os.getenv("CATALOG_PAGE_SIZE", "100"))
+CATALOG_CORS_ORIGIN = os.getenv("CATALOG_CORS_ORIGIN", "*")
+CATALOG_MAX_AGE = 30
+
+# Set METRICS_API=1 to serve Prometheus metrics at GET /metrics on PORT (in polling mode too)
+METRICS_API = os.getenv("METRICS_API", "0") == "1"
+
+# Logging: level, 'text' or 'json' lines, and LOG_UPDATES=1 to log whole updates
+# (channel posts, updates that caused an error) when debugging
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_UPDATES = os.getenv("LOG_UPDATES", "0") == "1"
+
+# Each info/debug line (by message template) is written at most LOG_RATE_LIMIT times per
+# minute (0: no limit); warnings and errors are never limited
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", "20"))
+LOG_RATE_WINDOW = 60
+
+# Set LOG_ROUND_TRIPS=1 to log the MongoDB and Bot API calls behind every handled update,
+# or a fraction (e.g. 0.01) to log a sample of them
+LOG_ROUND_TRIPS = float(os.getenv("LOG_ROUND_TRIPS", "0"))
+
+# Updates handled at the same time (updates from one user always run in order)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
+
+# Outbound Bot API budgets (requests per second): sent messages (Telegram allows ~30),
+# membership checks and everything else; messages per chat are limited separately
+OUTBOUND_MESSAGE_RATE = float(os.getenv("OUTBOUND_MESSAGE_RATE", "28"))
+OUTBOUND_CHECK_RATE = float(os.getenv("OUTBOUND_CHECK_RATE", "100"))
+OUTBOUND_OTHER_RATE = float(os.getenv("OUTBOUND_OTHER_RATE", "100"))
+PER_CHAT_RATE = 1.0
+PER_CHAT_BURST = 3
+OUTBOUND_MAX_RETRIES = 3
+OUTBOUND_MAX_FLOOD_WAITS = 5
+
+# Channel uploads: posts arriving within this many seconds (or one album) are saved
+# together and reported to the admin in one digest
+INGEST_WINDOW = float(os.getenv("INGEST_WINDOW", "3"))
+INGEST_BATCH_MAX = 50
+
+# Broadcast: messages per second. The default of 20 leaves 8 of the 28 a second in
+# OUTBOUND_MESSAGE_RATE for deliveries and replies while a broadcast runs.
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))
+BROADCAST_BATCH_SIZE = 100
+BROADCAST_CONCURRENCY = 10
+
 # ===================== LOGGING SETUP =====================
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Loggers only put records on a queue; a background thread formats and
+# writes them, so a slow stderr never stalls the event loop. Messages use
+# %-style arguments and are formatted by that thread, and LogSampler drops
+# noisy lines before they are queued.
+class LogSampler(logging.Filter):
+    """Sampling and rate limits for INFO and DEBUG lines.
+
+    A record logged with extra={'sample': p} is kept with probability p.
+    Any other line is kept at most `limit` times per `window` seconds per
+    message template. Warnings and errors are always kept. How many lines
+    were dropped is collected by the log writer thread (take_dropped).
+    """
+
+    def __init__(self, limit, window):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        # (logger, template) -> [window start, records, dropped]
+        self.lines = {}
+        # (logger, template) -> dropped lines not reported yet
+        self.dropped = Counter()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        sample = getattr(record, 'sample', None)
+        if sample is not None:
+            return sample >= 1 or random.random() < sample
+        if not self.limit:
+            return True
+        
+        template = record.msg if isinstance(record.msg, str) else type(record.msg).__name__
+        key = (record.name, template)
+        now = time.monotonic()
+        with self._lock:
+            line = self.lines.get(key)
+            if line is None or now - line[0] >= self.window:
+                if len(self.lines) >= 10000:
+                    self._close_windows(now, expired_only=False)
+                    self.lines.clear()
+                if line and line[2]:
+                    self.dropped[key] += line[2]
+                line = self.lines[key] = [now, 0, 0]
+            line[1] += 1
+            if line[1] > self.limit:
+                line[2] += 1
+                return False
+        return True
+
+    def _close_windows(self, now, expired_only=True):
+        for key, line in self.lines.items():
+            if line[2] and (not expired_only or now - line[0] >= self.window):
+                self.dropped[key] += line[2]
+                line[2] = 0
+
+    def take_dropped(self):
+        """{(logger, template): count} dropped in windows that have ended"""
+        with self._lock:
+            self._close_windows(time.monotonic())
+            dropped, self.dropped = self.dropped, Counter()
+        return dropped
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.utcfromtimestamp(record.created).isoformat(timespec='milliseconds') + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        if getattr(record, 'dropped', 0):
+            entry['dropped'] = record.dropped
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Queues records unformatted; the writer thread formats them"""
+
+    def prepare(self, record):
+        return record
+
+class LogWriter(logging.handlers.QueueListener):
+    """Writer thread that also reports lines the sampler dropped.
+
+    It wakes up at least once per rate-limit window, so a count is
+    written even if the dropped line never shows up again.
+    """
+
+    def __init__(self, log_queue, sampler, *handlers):
+        super().__init__(log_queue, *handlers)
+        self.sampler = sampler
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, timeout=self.sampler.window)
+            except queue.Empty:
+                self.report_dropped()
+
+    def report_dropped(self):
+        for (name, template), count in self.sampler.take_dropped().items():
+            record = logging.getLogger(name).makeRecord(
+                name, logging.WARNING, __file__, 0,
+                "%d lines like %r dropped by LOG_RATE_LIMIT", (count, template), None
+            )
+            record.dropped = count
+            self.handle(record)
+
+    def stop(self):
+        super().stop()
+        self.report_dropped()
+
+def setup_logging():
+    """Send all logging through a queue to a writer thread"""
+    stream = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        stream.setFormatter(JsonFormatter())
+    else:
+        stream.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    
+    log_queue = queue.SimpleQueue()
+    sampler = LogSampler(LOG_RATE_LIMIT, LOG_RATE_WINDOW)
+    handler = LazyQueueHandler(log_queue)
+    handler.addFilter(sampler)
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx logs every Bot API request at INFO
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    
+    listener = LogWriter(log_queue, sampler, stream)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
 # ===================== MONGODB SETUP =====================
 try:
     logger.info("🔄 Connecting to MongoDB...")
-    mongo_client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+    mongo_client = MongoClient(
+        MONGO_URI,
+        serverSelectionTimeoutMS=5000,
+        maxPoolSize=DB_POOL_SIZE
+    )
     mongo_client.server_info()
     db = mongo_client['cineflix_bot']
     
@@ -70,21 +382,1248 @@ try:
     users_col = db['users']
     settings_col = db['settings']
     messages_col = db['messages']
+    memberships_col = db['channel_members']
+    daily_stats_col = db['daily_stats']
+    broadcasts_col = db['broadcasts']
+    counters_col = db['counters']
+    video_views_col = db['video_views']
+    coviews_col = db['coviews']
+    recommendations_col = db['recommendations']
+    admin_states_col = db['admin_states']
+    leases_col = db['leases']
+    events_col = db['events']
     
     logger.info("✅ MongoDB Connected Successfully!")
     
 except (ConnectionFailure, OperationFailure) as e:
-    logger.error(f"❌ MongoDB Connection Failed: {e}")
+    logger.error("❌ MongoDB Connection Failed: %s", e)
     logger.error("Bot cannot run without database. Please check MONGO_URI.")
     sys.exit(1)
 
+# ===================== DATABASE INDEXES =====================
+INDEX_SPECS = {
+    'videos': [
+        IndexModel([('channel_id', ASCENDING), ('message_id', ASCENDING)],
+                   name='channel_message_unique', unique=True),
+        IndexModel([('message_id', ASCENDING)], name='message_id'),
+        IndexModel([('code', ASCENDING)], name='code_unique', unique=True, sparse=True),
+        IndexModel([('seq', ASCENDING)], name='seq_unique', unique=True, sparse=True),
+    ],
+    'users': [
+        IndexModel([('user_id', ASCENDING)], name='user_id_unique', unique=True),
+        IndexModel([('last_active_day', ASCENDING)], name='last_active_day'),
+        IndexModel([('first_seen', ASCENDING)], name='first_seen'),
+    ],
+    'settings': [
+        IndexModel([('key', ASCENDING)], name='key_unique', unique=True),
+    ],
+    'messages': [
+        IndexModel([('key', ASCENDING)], name='key_unique', unique=True),
+    ],
+    'force_join_channels': [
+        IndexModel([('channel_id', ASCENDING)], name='channel_id_unique', unique=True),
+        IndexModel([('is_active', ASCENDING)], name='is_active'),
+    ],
+    'channel_members': [
+        IndexModel([('user_id', ASCENDING), ('channel_id', ASCENDING)],
+                   name='user_channel_unique', unique=True),
+        IndexModel([('channel_id', ASCENDING)], name='channel_id'),
+    ],
+    'video_views': [
+        IndexModel([('period', ASCENDING), ('start', ASCENDING)], name='period_start'),
+        IndexModel([('expire_at', ASCENDING)], name='expire_at_ttl', expireAfterSeconds=0),
+    ],
+    'admin_states': [
+        IndexModel([('expire_at', ASCENDING)], name='expire_at_ttl', expireAfterSeconds=0),
+    ],
+    'events': [
+        IndexModel([('created_at', ASCENDING)], name='created_at_ttl',
+                   expireAfterSeconds=EVENT_RETENTION_SECONDS),
+    ],
+    'coviews': [
+        IndexModel([('a', ASCENDING), ('count', DESCENDING)], name='a_count'),
+        IndexModel([('last_seen', ASCENDING)], name='last_seen_ttl',
+                   expireAfterSeconds=RECOMMEND_RETENTION_DAYS * 86400),
+    ],
+}
+
+# (collection, filter) pairs for the queries on the request path
+HOT_QUERIES = [
+    ('videos', {'message_id': 1}),
+    ('videos', {'code': 'v1'}),
+    ('videos', {'seq': {'$gte': 100, '$lt': 200}}),
+    ('users', {'user_id': 1}),
+    ('users', {'last_active_day': '2024-01-01'}),
+    ('users', {'first_seen': {'$gte': datetime(2024, 1, 1), '$lt': datetime(2024, 1, 2)}}),
+    ('settings', {'key': 'mini_app_url'}),
+    ('messages', {'key': 'welcome'}),
+    ('force_join_channels', {'is_active': True}),
+    ('channel_members', {'user_id': 1, 'channel_id': {'$in': [-1001]}}),
+    ('video_views', {'period': 'hour', 'start': {'$gte': datetime(2024, 1, 1)}}),
+    ('coviews', {'a': 'v1'}),
+]
+
+INDEX_OPTIONS = ('unique', 'sparse', 'expireAfterSeconds', 'partialFilterExpression')
+
+def ensure_indexes():
+    """Create missing indexes and report conflicting ones.
+
+    Safe to run on every start: indexes that already exist with the same
+    keys and options are left alone. An existing index with the same name
+    or keys but different options is reported, never dropped.
+    Returns {'created': [...], 'conflicts': [...]}.
+    """
+    report = {'created': [], 'conflicts': []}
+    for col_name, models in INDEX_SPECS.items():
+        col = db[col_name]
+        try:
+            existing = col.index_information()
+        except OperationFailure as e:
+            report['conflicts'].append(f"{col_name}: cannot list indexes ({e})")
+            continue
+        by_key = {tuple(info['key']): (name, info) for name, info in existing.items()}
+        
+        for model in models:
+            spec = model.document
+            name = spec['name']
+            key = tuple(spec['key'].items())
+            wanted = {opt: spec[opt] for opt in INDEX_OPTIONS if opt in spec}
+            
+            found = by_key.get(key)
+            if found is None and name in existing:
+                report['conflicts'].append(
+                    f"{col_name}.{name}: name used by index on {existing[name]['key']}"
+                )
+                continue
+            if found is not None:
+                found_name, info = found
+                have = {opt: info[opt] for opt in INDEX_OPTIONS if opt in info}
+                if have != wanted:
+                    report['conflicts'].append(
+                        f"{col_name}.{found_name}: options {have} != {wanted}"
+                    )
+                continue
+            
+            try:
+                col.create_indexes([model])
+                report['created'].append(f"{col_name}.{name}")
+            except OperationFailure as e:
+                # e.g. duplicate values block a unique index
+                report['conflicts'].append(f"{col_name}.{name}: {e}")
+    
+    for item in report['created']:
+        logger.info("🗂️ Index created: %s", item)
+    for item in report['conflicts']:
+        logger.warning("⚠️ Index conflict: %s", item)
+    return report
+
+def find_collection_scans(plan):
+    """Return True if an explain() plan contains a COLLSCAN stage"""
+    if isinstance(plan, dict):
+        if plan.get('stage') == 'COLLSCAN':
+            return True
+        return any(find_collection_scans(v) for v in plan.values())
+    if isinstance(plan, list):
+        return any(find_collection_scans(v) for v in plan)
+    return False
+
+def check_query_plans():
+    """Run explain() on HOT_QUERIES and return the ones not using an index"""
+    uncovered = []
+    for col_name, query in HOT_QUERIES:
+        try:
+            plan = db[col_name].find(query).explain()
+            if find_collection_scans(plan.get('queryPlanner', {}).get('winningPlan', {})):
+                uncovered.append(f"{col_name} {query}")
+        except OperationFailure as e:
+            logger.error("Error explaining %s %s: %s", col_name, query, e)
+    
+    for item in uncovered:
+        logger.warning("⚠️ Query not covered by an index: %s", item)
+    if not uncovered:
+        logger.info("✅ All hot queries use an index")
+    return uncovered
+
+# ===================== METRICS =====================
+# Counters and latency histograms kept in plain dicts keyed by label
+# values. They are only updated from the event loop, so no locks are
+# needed and recording costs a dict lookup and a bisect. GET /metrics
+# renders them in the Prometheus text format.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROUND_TRIP_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 50)
+
+metrics_registry = []
+
+def format_labels(names, values, le=None):
+    """Prometheus label set, e.g. {handler="start",le="0.1"}"""
+    pairs = list(zip(names, values))
+    if le is not None:
+        pairs.append(('le', le))
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+class CounterMetric:
+    """A counter per label values"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = {}
+        metrics_registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        for label_values, value in self.values.items():
+            yield f"{self.name}{format_labels(self.labels, label_values)} {value}"
+
+class GaugeMetric:
+    """Values read from the running bot when metrics are rendered.
+
+    ``read`` returns {label values tuple: value}.
+    """
+
+    def __init__(self, name, help_text, labels, read, kind='gauge'):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.read = read
+        self.kind = kind
+        metrics_registry.append(self)
+
+    def render(self):
+        for label_values, value in self.read().items():
+            yield f"{self.name}{format_labels(self.labels, label_values)} {value}"
+
+class HistogramMetric:
+    """Latency histogram per label values: [bucket counts..., +Inf count], sum"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        metrics_registry.append(self)
+
+    def observe(self, seconds, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, seconds)] += 1
+        series[1] += seconds
+
+    def merged(self, match=lambda label_values: True):
+        """Bucket counts summed over the series whose label values match"""
+        counts = [0] * (len(self.buckets) + 1)
+        for label_values, (series_counts, _) in self.series.items():
+            if match(label_values):
+                counts = [a + b for a, b in zip(counts, series_counts)]
+        return counts
+
+    def quantile(self, q, counts):
+        """Upper bound of the bucket holding quantile q (None above the last bucket)"""
+        total = sum(counts)
+        if not total:
+            return 0
+        running = 0
+        for bound, count in zip(self.buckets, counts):
+            running += count
+            if running >= q * total:
+                return bound
+        return None
+
+    def render(self):
+        for label_values, (counts, total) in self.series.items():
+            running = 0
+            for bound, count in zip(self.buckets, counts):
+                running += count
+                yield f"{self.name}_bucket{format_labels(self.labels, label_values, bound)} {running}"
+            running += counts[-1]
+            yield f"{self.name}_bucket{format_labels(self.labels, label_values, '+Inf')} {running}"
+            yield f"{self.name}_sum{format_labels(self.labels, label_values)} {total:.6f}"
+            yield f"{self.name}_count{format_labels(self.labels, label_values)} {running}"
+
+def render_metrics():
+    """All metrics in the Prometheus text format"""
+    lines = []
+    for metric in metrics_registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+handler_seconds = HistogramMetric(
+    'bot_handler_seconds', 'Time spent handling updates', ('handler', 'outcome'))
+db_seconds = HistogramMetric(
+    'bot_db_seconds', 'MongoDB helper latency, including the wait for a pool thread', ('helper',))
+api_seconds = HistogramMetric(
+    'bot_api_seconds', 'Bot API call latency', ('method', 'outcome'))
+api_queue_seconds = HistogramMetric(
+    'bot_api_queue_seconds', 'Time Bot API calls waited in the outbound scheduler', ('lane',))
+handler_round_trips = HistogramMetric(
+    'bot_handler_round_trips', 'MongoDB helpers and Bot API calls per handled update',
+    ('handler', 'kind'), buckets=ROUND_TRIP_BUCKETS)
+cache_requests = CounterMetric(
+    'bot_cache_requests_total', 'In-memory cache lookups', ('cache', 'result'))
+membership_checks = CounterMetric(
+    'bot_membership_checks_total', 'Force-join membership answers by source', ('source',))
+
+# Read when rendered; the objects they read are defined further down
+GaugeMetric('bot_outbound_queued', 'Bot API calls waiting in the outbound scheduler', ('group', 'lane'),
+            lambda: {
+                (group, PRIORITY_NAMES[priority]): count
+                for group, lane in outbound.lanes.items() for priority, count in lane.depth.items()
+            })
+GaugeMetric('bot_outbound_in_flight', 'Bot API calls in flight', (),
+            lambda: {(): outbound.in_flight})
+GaugeMetric('bot_outbound_events_total', 'Outbound scheduler events', ('event',),
+            lambda: {(event,): count for event, count in outbound.counters.items()}, kind='counter')
+GaugeMetric('bot_write_behind_pending', 'Entries waiting in write-behind buffers', ('collection',),
+            lambda: {(buffer.collection.name,): len(buffer.pending) for buffer in write_behind_buffers})
+GaugeMetric('bot_cache_entries', 'Entries in in-memory caches', ('cache',),
+            lambda: {('membership',): len(membership_cache), ('video',): len(video_cache),
+                     ('search',): len(search_index), ('watch_next',): len(watch_next)})
+GaugeMetric('bot_objects', 'Users and videos (live counters)', ('kind',),
+            lambda: {(name,): count for name, count in live_stats.totals.items()})
+GaugeMetric('bot_running_broadcasts', 'Broadcasts being sent', (),
+            lambda: {(): len(running_broadcasts)})
+
+# Outcome of the handler running in the current task (a one-item list)
+handler_outcome = contextvars.ContextVar('handler_outcome', default=None)
+
+class RoundTrips:
+    """MongoDB helpers and Bot API calls made while handling one update"""
+
+    __slots__ = ('db', 'db_seconds', 'api', 'api_seconds', 'queue_seconds')
+
+    def __init__(self):
+        self.db = Counter()
+        self.db_seconds = 0.0
+        self.api = Counter()
+        self.api_seconds = 0.0
+        self.queue_seconds = 0.0
+
+    def add(self, other):
+        self.db.update(other.db)
+        self.db_seconds += other.db_seconds
+        self.api.update(other.api)
+        self.api_seconds += other.api_seconds
+        self.queue_seconds += other.queue_seconds
+
+    def __str__(self):
+        db = ' '.join(f"{name}×{n}" if n > 1 else name for name, n in self.db.items())
+        api = ' '.join(f"{name}×{n}" if n > 1 else name for name, n in self.api.items())
+        return (
+            f"db {sum(self.db.values())} ({self.db_seconds * 1000:.0f}ms) [{db}] · "
+            f"api {sum(self.api.values())} ({self.api_seconds * 1000:.0f}ms, "
+            f"queued {self.queue_seconds * 1000:.0f}ms) [{api}]"
+        )
+
+# Round trips of the update being handled in the current task. Calls
+# made by nested handlers are added to the outer one's when they finish.
+update_round_trips = contextvars.ContextVar('update_round_trips', default=None)
+
+def record_round_trips(name, outcome, trips):
+    """Called with every handled update's round trips"""
+    handler_round_trips.observe(sum(trips.db.values()), name, 'db')
+    handler_round_trips.observe(sum(trips.api.values()), name, 'api')
+    if LOG_ROUND_TRIPS:
+        logger.info("🔁 %s/%s: %s", name, outcome, trips, extra={'sample': LOG_ROUND_TRIPS})
+
+def instrumented(name):
+    """Decorator: record a handler's latency, labelled with its outcome.
+
+    The handler reports its outcome with set_outcome(); the default is
+    'ok', and 'error' if it raises.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            outcome = ['ok']
+            trips = RoundTrips()
+            token = handler_outcome.set(outcome)
+            trips_token = update_round_trips.set(trips)
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                outcome[0] = 'error'
+                raise
+            finally:
+                handler_outcome.reset(token)
+                update_round_trips.reset(trips_token)
+                handler_seconds.observe(time.perf_counter() - started, name, outcome[0])
+                record_round_trips(name, outcome[0], trips)
+                parent = update_round_trips.get()
+                if parent is not None:
+                    parent.add(trips)
+        return wrapper
+    return decorator
+
+def set_outcome(outcome):
+    """Label the current handler's latency with this outcome"""
+    holder = handler_outcome.get()
+    if holder is not None:
+        holder[0] = outcome
+
+# ===================== ASYNC DB EXECUTOR =====================
+# pymongo is blocking, so every helper runs on a bounded thread pool.
+# Handlers `await` the helpers and the event loop stays free while
+# MongoDB round-trips are in flight.
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="mongo")
+
+def run_in_db_executor(func):
+    """Turn a blocking DB helper into a coroutine function.
+
+    The original function stays available as ``func.sync`` for code that
+    runs outside the event loop (startup, executor threads).
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(
+                db_executor, functools.partial(func, *args, **kwargs)
+            )
+        finally:
+            elapsed = time.perf_counter() - started
+            db_seconds.observe(elapsed, func.__name__)
+            trips = update_round_trips.get()
+            if trips is not None:
+                trips.db[func.__name__] += 1
+                trips.db_seconds += elapsed
+    wrapper.sync = func
+    return wrapper
+
+# ===================== IN-MEMORY CACHES =====================
+class TTLCache:
+    """Bounded LRU cache where every entry has its own time-to-live"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, expires_at = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl):
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+# (user_id, channel_id) -> True (joined) / False (not joined)
+membership_cache = TTLCache(MEMBERSHIP_CACHE_SIZE)
+
+# short code -> video document, or VIDEO_NOT_FOUND for codes that resolve to nothing
+VIDEO_NOT_FOUND = object()
+video_cache = TTLCache(VIDEO_CACHE_SIZE)
+
+# ===================== LIVE STATISTICS =====================
+def day_key(when):
+    """Rollup key for a UTC datetime, e.g. '2026-10-18'"""
+    return when.strftime('%Y-%m-%d')
+
+class LiveStats:
+    """Counters for the admin panel, kept in memory.
+
+    Totals are bumped by the write helpers and re-counted every
+    STATS_RECONCILE_INTERVAL seconds. Daily active/new users come from
+    the daily_stats rollups ({'_id': day, 'active_users', 'new_users'}).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.totals = {'users': 0, 'videos': 0}
+        self.daily = {}
+
+    def add(self, name, amount=1):
+        with self._lock:
+            self.totals[name] += amount
+
+    def raise_daily(self, day, active_users, new_users):
+        """Raise a day's counts to freshly counted values (never lowers them)"""
+        with self._lock:
+            active, new = self.daily.get(day, (0, 0))
+            self.daily[day] = (max(active, active_users), max(new, new_users))
+
+    def reconcile(self):
+        """Re-count totals and reload recent rollups (blocking)"""
+        totals = {
+            'users': users_col.estimated_document_count(),
+            'videos': videos_col.estimated_document_count()
+        }
+        first_day = day_key(datetime.utcnow() - timedelta(days=STATS_DAYS_SHOWN - 1))
+        daily = {
+            doc['_id']: (doc.get('active_users', 0), doc.get('new_users', 0))
+            for doc in daily_stats_col.find({'_id': {'$gte': first_day}})
+        }
+        with self._lock:
+            self.totals = totals
+            self.daily = daily
+
+live_stats = LiveStats()
+
+@run_in_db_executor
+def reconcile_stats():
+    """Correct the live counters from the database"""
+    try:
+        live_stats.reconcile()
+    except Exception as e:
+        logger.error("Error reconciling stats: %s", e)
+
+async def reconcile_stats_periodically():
+    """Background job: reconcile the live counters"""
+    while True:
+        await asyncio.sleep(STATS_RECONCILE_INTERVAL)
+        await reconcile_stats()
+
+# ===================== RATE LIMITING =====================
+def retry_after_seconds(error):
+    """RetryAfter.retry_after as seconds (int or timedelta depending on PTB version)"""
+    delay = error.retry_after
+    return delay.total_seconds() if isinstance(delay, timedelta) else float(delay)
+
+class TokenBucket:
+    """Async token bucket: ``rate`` tokens per second, bursts up to ``capacity``"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+    def pause(self, seconds):
+        """Hand out no tokens for the next ``seconds`` (after a flood wait)"""
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+# ===================== OUTBOUND SCHEDULER =====================
+# Every Bot API call goes through OutboundScheduler (PTB's rate limiter
+# hook). Calls wait in priority lanes per budget group; the lane with the
+# lowest number is served first whenever the group's bucket has a token.
+PRIORITY_DELIVERY = 0      # video delivery and force-join checks
+PRIORITY_INTERACTIVE = 1   # replies to user actions (welcome, help)
+PRIORITY_ADMIN = 2         # admin panel and admin notifications
+PRIORITY_BULK = 3          # broadcasts
+
+PRIORITY_NAMES = {
+    PRIORITY_DELIVERY: 'delivery',
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_ADMIN: 'admin',
+    PRIORITY_BULK: 'bulk',
+}
+
+# Max queued calls per lane; over the limit a call fails instead of piling up.
+# Delivery and bulk are never dropped (broadcasts pace themselves).
+LANE_LIMITS = {
+    PRIORITY_DELIVERY: None,
+    PRIORITY_INTERACTIVE: 2000,
+    PRIORITY_ADMIN: 500,
+    PRIORITY_BULK: None,
+}
+
+# Lane used by Bot API calls made from the current task
+outbound_priority = contextvars.ContextVar('outbound_priority', default=PRIORITY_INTERACTIVE)
+
+def in_lane(priority):
+    """Decorator: Bot API calls made inside the coroutine use this lane"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            token = outbound_priority.set(priority)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                outbound_priority.reset(token)
+        return wrapper
+    return decorator
+
+# CONCURRENT_UPDATES slot of the update the current task belongs to
+update_slot = contextvars.ContextVar('update_slot', default=None)
+
+class OutboundQueueFull(TelegramError):
+    """A low-priority Bot API call was dropped because its lane is full"""
+
+def method_group(endpoint):
+    """Budget group of a Bot API endpoint"""
+    if endpoint == 'getChatMember':
+        return 'membership'
+    if endpoint.startswith(('send', 'copy', 'forward', 'edit')):
+        return 'messages'
+    return 'other'
+
+def safe_to_retry(endpoint, error):
+    """Whether a call that failed with a network error can be sent again.
+
+    A send/copy/forward that timed out while waiting for the answer has
+    usually been delivered already, so those are only retried when the
+    request never left (no connection, or no free one in the pool).
+    """
+    if not endpoint.startswith(('send', 'copy', 'forward')):
+        return True
+    return isinstance(error.__cause__, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+class OutboundLane:
+    """Waiting calls of one budget group, ordered by (priority, arrival)"""
+
+    def __init__(self, rate):
+        self.bucket = TokenBucket(rate, max(rate, 1))
+        self.heap = []
+        self.depth = Counter()
+        self.wakeup = asyncio.Event()
+
+class OutboundScheduler(BaseRateLimiter):
+    """Central outbound Bot API scheduler.
+
+    - one token bucket per budget group (messages, membership, other)
+      plus a small bucket per chat for sent messages
+    - priority lanes, so deliveries go before admin notifications
+    - RetryAfter pauses the buckets and retries; network errors are
+      retried with jittered exponential backoff when safe_to_retry
+    """
+
+    def __init__(self):
+        self.rates = {
+            'messages': OUTBOUND_MESSAGE_RATE,
+            'membership': OUTBOUND_CHECK_RATE,
+            'other': OUTBOUND_OTHER_RATE,
+        }
+        self.lanes = {}
+        self.chat_buckets = TTLCache(10000)
+        self._seq = itertools.count()
+        self._dispatchers = []
+        self.in_flight = 0
+        self.counters = Counter()
+
+    async def initialize(self):
+        if self._dispatchers:
+            return  # the bot may be initialized more than once
+        self.lanes = {group: OutboundLane(rate) for group, rate in self.rates.items()}
+        self._dispatchers = [
+            asyncio.create_task(self._dispatch(lane)) for lane in self.lanes.values()
+        ]
+
+    async def shutdown(self):
+        for task in self._dispatchers:
+            task.cancel()
+        await asyncio.gather(*self._dispatchers, return_exceptions=True)
+        self._dispatchers = []
+
+    async def _dispatch(self, lane):
+        """Release waiting calls in priority order as tokens come in"""
+        while True:
+            while not lane.heap:
+                lane.wakeup.clear()
+                await lane.wakeup.wait()
+            await lane.bucket.acquire()
+            priority, _, turn = heapq.heappop(lane.heap)
+            lane.depth[priority] -= 1
+            if not turn.done():
+                turn.set_result(None)
+
+    async def _wait_turn(self, lane, priority, chat_id):
+        if chat_id is not None:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = TokenBucket(PER_CHAT_RATE, PER_CHAT_BURST)
+            self.chat_buckets.set(chat_id, bucket, 60)
+            await bucket.acquire()
+        
+        limit = LANE_LIMITS.get(priority)
+        if limit is not None and lane.depth[priority] >= limit:
+            self.counters['dropped'] += 1
+            raise OutboundQueueFull(f"Outbound {PRIORITY_NAMES[priority]} lane is full")
+        
+        turn = asyncio.get_running_loop().create_future()
+        heapq.heappush(lane.heap, (priority, next(self._seq), turn))
+        lane.depth[priority] += 1
+        lane.wakeup.set()
+        await turn
+
+    def _pause(self, lane, chat_id, seconds):
+        lane.bucket.pause(seconds)
+        bucket = self.chat_buckets.get(chat_id) if chat_id is not None else None
+        if bucket:
+            bucket.pause(seconds)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = rate_limit_args if isinstance(rate_limit_args, int) else outbound_priority.get()
+        group = method_group(endpoint)
+        lane = self.lanes[group]
+        chat_id = data.get('chat_id') if group == 'messages' else None
+        
+        trips = update_round_trips.get()
+        slot = update_slot.get()
+        flood_waits = 0
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            if slot is None:
+                await self._wait_turn(lane, priority, chat_id)
+            else:
+                await slot.released_while(self._wait_turn(lane, priority, chat_id))
+            waited = time.perf_counter() - started
+            api_queue_seconds.observe(waited, PRIORITY_NAMES[priority])
+            
+            self.in_flight += 1
+            outcome = 'error'
+            started = time.perf_counter()
+            try:
+                result = await callback(*args, **kwargs)
+                outcome = 'ok'
+                self.counters['sent'] += 1
+                return result
+            except RetryAfter as e:
+                outcome = 'flood_wait'
+                flood_waits += 1
+                self.counters['flood_waits'] += 1
+                if flood_waits > OUTBOUND_MAX_FLOOD_WAITS:
+                    self.counters['failed'] += 1
+                    raise
+                delay = retry_after_seconds(e)
+                logger.warning("⏳ Flood wait %ss on %s", delay, endpoint)
+                self._pause(lane, chat_id, delay)
+            except (BadRequest, Forbidden) as e:
+                outcome = 'forbidden' if isinstance(e, Forbidden) else 'bad_request'
+                self.counters['failed'] += 1
+                raise
+            except NetworkError as e:
+                outcome = 'network_error'
+                attempt += 1
+                if attempt > OUTBOUND_MAX_RETRIES or not safe_to_retry(endpoint, e):
+                    self.counters['failed'] += 1
+                    raise
+                self.counters['retries'] += 1
+                await asyncio.sleep(0.5 * 2 ** attempt * random.uniform(0.5, 1.5))
+            finally:
+                self.in_flight -= 1
+                elapsed = time.perf_counter() - started
+                api_seconds.observe(elapsed, endpoint, outcome)
+                if trips is not None:
+                    trips.api[endpoint] += 1
+                    trips.api_seconds += elapsed
+                    trips.queue_seconds += waited
+
+    def metrics(self):
+        """Queue depths per group/lane and call counters"""
+        return {
+            'queued': {
+                group: {PRIORITY_NAMES[p]: n for p, n in lane.depth.items() if n}
+                for group, lane in self.lanes.items()
+            },
+            'queued_total': sum(sum(lane.depth.values()) for lane in self.lanes.values()),
+            'in_flight': self.in_flight,
+            **{name: self.counters[name] for name in ('sent', 'retries', 'flood_waits', 'dropped', 'failed')}
+        }
+
+outbound = OutboundScheduler()
+
+# ===================== WRITE-BEHIND BUFFERS =====================
+class WriteBehindBuffer:
+    """Collects writes in memory and sends them with one bulk_write.
+
+    Subclasses fill ``self.pending`` and implement ``operations`` and
+    ``merge_back``. A flush runs every ``interval`` seconds, as soon as
+    ``max_pending`` entries are buffered, and once more on shutdown.
+    """
+
+    def __init__(self, collection, interval, max_pending):
+        self.collection = collection
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending = {}
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+
+    def operations(self, batch):
+        """Turn a batch of pending entries into bulk_write operations"""
+        raise NotImplementedError
+
+    def merge_back(self, batch):
+        """Put a batch that failed to write back into the buffer"""
+        raise NotImplementedError
+
+    def entry_added(self):
+        if len(self.pending) >= self.max_pending:
+            self._wakeup.set()
+
+    def write(self, batch):
+        """Write one batch (blocking, run in the DB executor)"""
+        try:
+            self.collection.bulk_write(self.operations(batch), ordered=False)
+            return True
+        except PyMongoError as e:
+            logger.error("Error flushing %s buffer: %s", self.collection.name, e)
+            return False
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, {}
+            loop = asyncio.get_running_loop()
+            started = time.perf_counter()
+            written = await loop.run_in_executor(db_executor, self.write, batch)
+            db_seconds.observe(time.perf_counter() - started, f"flush_{self.collection.name}")
+            if not written:
+                self.merge_back(batch)
+
+    async def run(self):
+        """Background job: flush on interval or when the buffer is full"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+class ViewCounter(WriteBehindBuffer):
+    """Coalesces view increments: {(channel_id, message_id, code, hour): views}
+
+    A flush adds the views to each video and to its hourly and daily
+    buckets in video_views, then refreshes the trending list.
+    """
+
+    def add(self, channel_id, message_id, code=None, views=1, hour=None):
+        hour = hour or datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        key = (channel_id, message_id, code, hour)
+        self.pending[key] = self.pending.get(key, 0) + views
+        self.entry_added()
+
+    def operations(self, batch):
+        per_video = Counter()
+        for (channel_id, message_id, _, _), views in batch.items():
+            per_video[(channel_id, message_id)] += views
+        return [
+            UpdateOne({'channel_id': channel_id, 'message_id': message_id},
+                      {'$inc': {'views': views}})
+            for (channel_id, message_id), views in per_video.items()
+        ]
+
+    def bucket_operations(self, batch):
+        buckets = Counter()
+        for (_, _, code, hour), views in batch.items():
+            if code:
+                buckets[(code, 'hour', hour)] += views
+                buckets[(code, 'day', hour.replace(hour=0))] += views
+        
+        retention = {
+            'hour': timedelta(days=VIEW_HOURLY_RETENTION_DAYS),
+            'day': timedelta(days=VIEW_DAILY_RETENTION_DAYS),
+        }
+        return [
+            UpdateOne(
+                {'_id': f"{code}:{period}:{start:%Y%m%d%H}"},
+                {
+                    '$inc': {'views': views},
+                    '$setOnInsert': {
+                        'code': code,
+                        'period': period,
+                        'start': start,
+                        'expire_at': start + retention[period]
+                    }
+                },
+                upsert=True
+            )
+            for (code, period, start), views in buckets.items()
+        ]
+
+    def write(self, batch):
+        """Write one batch to videos and video_views (blocking)"""
+        try:
+            self.collection.bulk_write(self.operations(batch), ordered=False)
+        except PyMongoError as e:
+            logger.error("Error flushing %s buffer: %s", self.collection.name, e)
+            return False
+        try:
+            bucket_operations = self.bucket_operations(batch)
+            if bucket_operations:
+                video_views_col.bulk_write(bucket_operations, ordered=False)
+        except PyMongoError as e:
+            # The totals are written; losing some bucket views beats counting them twice
+            logger.error("Error writing view buckets: %s", e)
+        return True
+
+    def merge_back(self, batch):
+        for (channel_id, message_id, code, hour), views in batch.items():
+            self.add(channel_id, message_id, code, views, hour)
+
+    async def flush(self):
+        await super().flush()
+        trending.refresh()
+
+class UserActivityBuffer(WriteBehindBuffer):
+    """Coalesces user upserts: {user_id: latest profile and activity}
+
+    Users whose profile was written less than USER_REFRESH_WINDOW seconds
+    ago, and has not changed, are skipped entirely.
+    """
+
+    def __init__(self, collection, interval, max_pending):
+        super().__init__(collection, interval, max_pending)
+        # user_id -> (username, first_name) last buffered
+        self.recent = TTLCache(USER_RECENT_CACHE_SIZE)
+
+    def add(self, user_id, username, first_name):
+        profile = (username, first_name)
+        if self.recent.get(user_id) == profile:
+            return
+        self.recent.set(user_id, profile, USER_REFRESH_WINDOW)
+        
+        now = datetime.utcnow()
+        entry = self.pending.get(user_id)
+        self.pending[user_id] = {
+            'username': username,
+            'first_name': first_name,
+            'last_active': now,
+            'first_seen': entry['first_seen'] if entry else now
+        }
+        self.entry_added()
+
+    def operations(self, batch):
+        return [
+            UpdateOne(
+                {'user_id': user_id},
+                {
+                    '$set': {
+                        'user_id': user_id,
+                        'username': entry['username'],
+                        'first_name': entry['first_name'],
+                        'last_active': entry['last_active'],
+                        'last_active_day': day_key(entry['last_active']),
+                        # Talking to the bot again means it is no longer blocked
+                        'blocked': False
+                    },
+                    '$setOnInsert': {'first_seen': entry['first_seen']}
+                },
+                upsert=True
+            )
+            for user_id, entry in batch.items()
+        ]
+
+    def write(self, batch):
+        """Write one batch and re-count active/new users per day (blocking)
+
+        A day's counts are counted from the users collection (last_active_day
+        and first_seen) and only ever raised with $max, so a flush retried
+        after a partial failure neither loses nor double-counts a user.
+        Users who come back after midnight leave the previous day's count;
+        $max keeps the day's highest.
+        """
+        try:
+            result = self.collection.bulk_write(self.operations(batch), ordered=False)
+            live_stats.add('users', result.upserted_count)
+            
+            for day in {day_key(entry['last_active']) for entry in batch.values()}:
+                start = datetime.strptime(day, '%Y-%m-%d')
+                active = self.collection.count_documents({'last_active_day': day})
+                new = self.collection.count_documents(
+                    {'first_seen': {'$gte': start, '$lt': start + timedelta(days=1)}}
+                )
+                daily_stats_col.update_one(
+                    {'_id': day},
+                    {'$max': {'active_users': active, 'new_users': new}},
+                    upsert=True
+                )
+                live_stats.raise_daily(day, active, new)
+            return True
+        except PyMongoError as e:
+            logger.error("Error flushing %s buffer: %s", self.collection.name, e)
+            return False
+
+    def merge_back(self, batch):
+        for user_id, entry in batch.items():
+            newer = self.pending.get(user_id)
+            if newer:
+                newer['first_seen'] = entry['first_seen']
+            else:
+                self.pending[user_id] = entry
+
+class CoViewBuffer(WriteBehindBuffer):
+    """Coalesces co-view counts: {(code_a, code_b): times watched together}
+
+    Codes whose pairs changed are collected in ``dirty`` for the next
+    recommendation rebuild.
+    """
+
+    def __init__(self, collection, interval, max_pending):
+        super().__init__(collection, interval, max_pending)
+        self.dirty = set()
+
+    def add(self, code_a, code_b, count=1):
+        key = (code_a, code_b)
+        self.pending[key] = self.pending.get(key, 0) + count
+        self.dirty.add(code_a)
+        self.entry_added()
+
+    def operations(self, batch):
+        now = datetime.utcnow()
+        return [
+            UpdateOne(
+                {'_id': f"{code_a}:{code_b}"},
+                {
+                    '$inc': {'count': count},
+                    '$set': {'a': code_a, 'b': code_b, 'last_seen': now}
+                },
+                upsert=True
+            )
+            for (code_a, code_b), count in batch.items()
+        ]
+
+    def merge_back(self, batch):
+        for (code_a, code_b), count in batch.items():
+            self.add(code_a, code_b, count)
+
+view_counter = ViewCounter(videos_col, VIEW_FLUSH_INTERVAL, VIEW_FLUSH_MAX)
+user_activity = UserActivityBuffer(users_col, USER_FLUSH_INTERVAL, USER_FLUSH_MAX)
+coview_buffer = CoViewBuffer(coviews_col, VIEW_FLUSH_INTERVAL, VIEW_FLUSH_MAX)
+write_behind_buffers = [view_counter, user_activity, coview_buffer]
+
+# ===================== TRENDING =====================
+class TrendingTracker:
+    """Trending videos by exponentially decaying view count.
+
+    A view at time t adds 2 ** ((t - epoch) / half_life) to the video's
+    score, so old views never need to be decayed one by one; dividing by
+    the same weight for "now" gives the decayed view count. The top list
+    is recomputed with a heap when views are flushed, and reads only
+    return that list.
+    """
+
+    def __init__(self, half_life_hours, size, tracked):
+        self.half_life = half_life_hours * 3600
+        self.size = size
+        self.tracked = tracked
+        self.epoch = time.time()
+        self.scores = {}
+        self.top = []
+        self.page = None
+
+    def weight(self, at):
+        return 2 ** ((at - self.epoch) / self.half_life)
+
+    def record(self, code, views=1, at=None):
+        if code:
+            self.scores[code] = self.scores.get(code, 0) + views * self.weight(at or time.time())
+
+    def refresh(self):
+        """Recompute the top list (and the catalog API page)"""
+        now = time.time()
+        if now - self.epoch > 50 * self.half_life:
+            # Rescale before the weights get huge
+            factor = self.weight(now)
+            self.scores = {code: score / factor for code, score in self.scores.items()}
+            self.epoch = now
+        if len(self.scores) > self.tracked:
+            self.scores = dict(heapq.nlargest(self.tracked, self.scores.items(), key=lambda item: item[1]))
+        
+        current = self.weight(now)
+        top = [
+            (code, round(score / current, 1))
+            for code, score in heapq.nlargest(self.size, self.scores.items(), key=lambda item: item[1])
+        ]
+        if top != self.top or self.page is None:
+            self.top = top
+            if CATALOG_API:
+                self.page = trending_page(top)
+
+trending = TrendingTracker(TRENDING_HALF_LIFE_HOURS, TRENDING_SIZE, TRENDING_TRACKED)
+
+@run_in_db_executor
+def load_trending():
+    """Seed trending scores from the recent hourly view buckets"""
+    try:
+        since = datetime.utcnow() - timedelta(seconds=trending.half_life * 4)
+        offset = time.time() - datetime.utcnow().timestamp()
+        for bucket in video_views_col.find({'period': 'hour', 'start': {'$gte': since}}):
+            middle = bucket['start'] + timedelta(minutes=30)
+            trending.record(bucket['code'], bucket['views'], middle.timestamp() + offset)
+        return True
+    except Exception as e:
+        logger.error("Error loading trending: %s", e)
+        return False
+
+# ===================== RECOMMENDATIONS =====================
+# Videos delivered to the same user within a session are "watched
+# together". Pair counts are written behind, and a background job turns
+# them into the top RECOMMEND_COUNT videos per video, stored in the
+# recommendations collection and kept in memory for delivery.
+
+# user_id -> codes of the videos the user got most recently (newest last)
+watch_history = TTLCache(USER_RECENT_CACHE_SIZE)
+# code -> recommended codes
+watch_next = {}
+
+def record_coview(user_id, code):
+    """Count a delivered video as watched together with the user's recent ones"""
+    if not code:
+        return
+    history = watch_history.get(user_id, ())
+    for previous in history:
+        if previous != code:
+            coview_buffer.add(previous, code)
+            coview_buffer.add(code, previous)
+    history = tuple(c for c in history if c != code)[-(RECOMMEND_HISTORY - 1):] + (code,)
+    watch_history.set(user_id, history, RECOMMEND_SESSION_HOURS * 3600)
+
+@run_in_db_executor
+def load_recommendations(codes=None):
+    """Load the stored recommendations (all, or for these codes) into memory"""
+    try:
+        query = {'_id': {'$in': codes}} if codes is not None else {}
+        for doc in recommendations_col.find(query):
+            watch_next[doc['_id']] = doc['items']
+        if codes is None:
+            logger.info("🎯 Recommendations loaded for %s videos", len(watch_next))
+        return True
+    except Exception as e:
+        logger.error("Error loading recommendations: %s", e)
+        return False
+
+@run_in_db_executor
+def build_recommendations(codes):
+    """Recompute and store the top co-viewed videos for these codes"""
+    try:
+        result = {}
+        for code in codes:
+            pairs = coviews_col.find({'a': code}, {'b': 1}).sort('count', DESCENDING).limit(RECOMMEND_COUNT)
+            result[code] = [pair['b'] for pair in pairs]
+        if result:
+            now = datetime.utcnow()
+            recommendations_col.bulk_write([
+                UpdateOne({'_id': code}, {'$set': {'items': items, 'updated_at': now}}, upsert=True)
+                for code, items in result.items()
+            ], ordered=False)
+        return result
+    except Exception as e:
+        logger.error("Error building recommendations: %s", e)
+        return None
+
+async def rebuild_recommendations():
+    """Rebuild recommendations for videos whose co-views changed"""
+    await coview_buffer.flush()
+    codes, coview_buffer.dirty = coview_buffer.dirty, set()
+    if not codes:
+        return
+    result = await build_recommendations(codes)
+    if result is None:
+        coview_buffer.dirty |= codes
+        return
+    watch_next.update(result)
+    await publish_event('recommendations', list(result))
+    logger.info("🎯 Rebuilt recommendations for %s videos", len(result))
+
+async def rebuild_recommendations_periodically():
+    """Background job: rebuild recommendations every RECOMMEND_REBUILD_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(RECOMMEND_REBUILD_INTERVAL)
+        await rebuild_recommendations()
+
+def watch_next_buttons(bot_username, code):
+    """Deep-link buttons for the videos to watch after this one (falls back to trending)"""
+    codes = watch_next.get(code) or [c for c, _ in trending.top]
+    buttons = []
+    for other in codes:
+        if other == code:
+            continue
+        entry = search_index.videos.get(other)
+        if entry is None:
+            continue
+        title = (entry['caption'] or entry['channel_name'] or other).split('\n')[0][:40]
+        buttons.append([InlineKeyboardButton(
+            f"▶️ {title}", url=f"https://t.me/{bot_username}?start={other}"
+        )])
+        if len(buttons) == RECOMMEND_COUNT:
+            break
+    return buttons
+
+# How long Telegram keeps undelivered updates, and how often we prove we are online
+MEMBERSHIP_UPDATE_RETENTION_HOURS = 23
+MEMBERSHIP_HEARTBEAT_INTERVAL = 600
+
 # ===================== CONVERSATION STATES =====================
 EDITING_MESSAGE = 1
 ADDING_CHANNEL = 2
 EDITING_SETTING = 3
 
-# Admin state tracking
-admin_states = {}
+# Admin edit flows keep their state in MongoDB ({'_id': user_id, 'action': ...}),
+# so the next message can be handled by any replica; abandoned flows expire
+@run_in_db_executor
+def get_admin_state(user_id):
+    """Current admin flow state, or None"""
+    try:
+        return admin_states_col.find_one({'_id': user_id, 'expire_at': {'$gt': datetime.utcnow()}})
+    except Exception as e:
+        logger.error("Error reading admin state: %s", e)
+        return None
+
+@run_in_db_executor
+def set_admin_state(user_id, state):
+    """Start or advance an admin flow"""
+    try:
+        admin_states_col.replace_one(
+            {'_id': user_id},
+            {**state, 'expire_at': datetime.utcnow() + timedelta(seconds=ADMIN_STATE_TTL)},
+            upsert=True
+        )
+        return True
+    except Exception as e:
+        logger.error("Error saving admin state: %s", e)
+        return False
+
+@run_in_db_executor
+def pop_admin_state(user_id):
+    """End the admin flow and return its state (None if there was none)"""
+    try:
+        return admin_states_col.find_one_and_delete(
+            {'_id': user_id, 'expire_at': {'$gt': datetime.utcnow()}}
+        )
+    except Exception as e:
+        logger.error("Error clearing admin state: %s", e)
+        return None
 
 # ===================== DEFAULT MESSAGES =====================
 DEFAULT_MESSAGES = {
@@ -176,20 +1715,83 @@ DEFAULT_SETTINGS = {
     'main_channel_id': -1003872857468,
     'main_channel_username': 'Cinaflixsteem',
     'video_protection': True,
+    'delivery_mode': 'copy',
     'bot_name': 'CINEFLIX'
 }
 
+# ===================== CONFIG CACHE =====================
+class ConfigCache:
+    """In-memory copy of the settings, messages and force join collections.
+
+    These collections are tiny, so they are loaded whole at startup and
+    reloaded every CONFIG_CACHE_TTL seconds. Writes go through
+    set_setting/set_message and the channel helpers, which update the
+    cache right away.
+    """
+
+    def __init__(self):
+        self.settings = {}
+        self.messages = {}
+        self.channels = []
+        self.loaded = False
+
+    def reload_channels(self):
+        """Reload active force join channels (blocking)"""
+        self.channels = list(force_join_col.find({'is_active': True}))
+
+    def reload(self):
+        """Reload all collections (blocking, run in the DB executor)"""
+        settings = {
+            doc['key']: doc.get('value')
+            for doc in settings_col.find({}, {'_id': 0, 'key': 1, 'value': 1})
+        }
+        messages = {
+            doc['key']: doc.get('text', '')
+            for doc in messages_col.find({}, {'_id': 0, 'key': 1, 'text': 1})
+        }
+        # Swap whole dicts so readers never see a half-loaded cache
+        self.settings = settings
+        self.messages = messages
+        self.reload_channels()
+        self.loaded = True
+
+config_cache = ConfigCache()
+
+@run_in_db_executor
+def load_config_cache():
+    """Load settings, messages and channels into the in-memory cache"""
+    try:
+        config_cache.reload()
+        return True
+    except Exception as e:
+        logger.error("Error loading config cache: %s", e)
+        return False
+
+async def refresh_config_cache_periodically():
+    """Background job: reload the config cache every CONFIG_CACHE_TTL seconds"""
+    while True:
+        await asyncio.sleep(CONFIG_CACHE_TTL)
+        await load_config_cache()
+
 # ===================== DATABASE HELPER FUNCTIONS =====================
 
-def get_setting(key, default=None):
+@run_in_db_executor
+def fetch_setting(key, default=None):
     """Get setting from database"""
     try:
         setting = settings_col.find_one({'key': key})
         return setting['value'] if setting else default
     except Exception as e:
-        logger.error(f"Error getting setting {key}: {e}")
+        logger.error("Error getting setting %s: %s", key, e)
         return default
 
+async def get_setting(key, default=None):
+    """Get setting (from the config cache once it is loaded)"""
+    if config_cache.loaded:
+        return config_cache.settings.get(key, default)
+    return await fetch_setting(key, default)
+
+@run_in_db_executor
 def set_setting(key, value):
     """Set setting in database"""
     try:
@@ -198,20 +1800,31 @@ def set_setting(key, value):
             {'$set': {'key': key, 'value': value, 'updated_at': datetime.utcnow()}},
             upsert=True
         )
+        config_cache.settings[key] = value
+        publish_event.sync('config')
         return True
     except Exception as e:
-        logger.error(f"Error setting {key}: {e}")
+        logger.error("Error setting %s: %s", key, e)
         return False
 
-def get_message(key):
+@run_in_db_executor
+def fetch_message(key):
     """Get message template from database"""
     try:
         msg = messages_col.find_one({'key': key})
         return msg['text'] if msg else DEFAULT_MESSAGES.get(key, '')
     except Exception as e:
-        logger.error(f"Error getting message {key}: {e}")
+        logger.error("Error getting message %s: %s", key, e)
         return DEFAULT_MESSAGES.get(key, '')
 
+async def get_message(key):
+    """Get message template (from the config cache once it is loaded)"""
+    if config_cache.loaded:
+        text = config_cache.messages.get(key)
+        return text if text is not None else DEFAULT_MESSAGES.get(key, '')
+    return await fetch_message(key)
+
+@run_in_db_executor
 def set_message(key, text):
     """Set message template in database"""
     try:
@@ -220,132 +1833,309 @@ def set_message(key, text):
             {'$set': {'key': key, 'text': text, 'updated_at': datetime.utcnow()}},
             upsert=True
         )
+        config_cache.messages[key] = text
+        publish_event.sync('config')
         return True
     except Exception as e:
-        logger.error(f"Error setting message {key}: {e}")
+        logger.error("Error setting message %s: %s", key, e)
         return False
 
+@run_in_db_executor
 def initialize_defaults():
     """Initialize default settings and messages if not exists"""
     try:
         # Initialize settings
         for key, value in DEFAULT_SETTINGS.items():
             if not settings_col.find_one({'key': key}):
-                set_setting(key, value)
+                set_setting.sync(key, value)
         
         # Initialize messages
         for key, text in DEFAULT_MESSAGES.items():
             if not messages_col.find_one({'key': key}):
-                set_message(key, text)
+                set_message.sync(key, text)
         
         logger.info("✅ Default settings and messages initialized")
     except Exception as e:
-        logger.error(f"Error initializing defaults: {e}")
+        logger.error("Error initializing defaults: %s", e)
 
-def save_video(channel_id, message_id, channel_name="Main"):
-    """Save video to database"""
+@run_in_db_executor
+def save_videos(videos):
+    """Save a batch of videos in one bulk write
+
+    Each video is a dict with channel_id, message_id and channel_name.
+    New videos get a short code; re-posted videos keep their code and
+    view count. Returns (new_count, saved documents in input order).
+    """
     try:
-        video_data = {
-            'channel_id': channel_id,
-            'message_id': message_id,
-            'channel_name': channel_name,
-            'saved_at': datetime.utcnow(),
-            'views': 0
+        now = datetime.utcnow()
+        first_seq = reserve_sequence('videos', len(videos))
+        operations = [
+            UpdateOne(
+                {'channel_id': video['channel_id'], 'message_id': video['message_id']},
+                {
+                    '$set': {**video, 'saved_at': now},
+                    '$setOnInsert': {
+                        'views': 0,
+                        'seq': first_seq + i,
+                        'code': video_code(first_seq + i)
+                    }
+                },
+                upsert=True
+            )
+            for i, video in enumerate(videos)
+        ]
+        result = videos_col.bulk_write(operations, ordered=False)
+        if result.upserted_count:
+            live_stats.add('videos', result.upserted_count)
+        
+        # Re-posted videos keep their old code, so read the codes back
+        saved = {
+            (doc['channel_id'], doc['message_id']): doc
+            for doc in videos_col.find({'$or': [
+                {'channel_id': video['channel_id'], 'message_id': video['message_id']}
+                for video in videos
+            ]})
         }
-        videos_col.update_one(
-            {'channel_id': channel_id, 'message_id': message_id},
-            {'$set': video_data},
-            upsert=True
-        )
-        logger.info(f"✅ Video saved: {channel_name} - {message_id}")
-        return True
+        for doc in saved.values():
+            video_cache.pop(doc['code'])
+            video_cache.pop(str(doc['message_id']))
+        publish_event.sync('videos', [doc['code'] for doc in saved.values()])
+        
+        logger.info("✅ Saved %s videos (%s new)", len(videos), result.upserted_count)
+        return result.upserted_count, [
+            saved[(video['channel_id'], video['message_id'])] for video in videos
+        ]
     except Exception as e:
-        logger.error(f"Error saving video: {e}")
-        return False
+        logger.error("Error saving videos: %s", e)
+        return None
 
-def get_video(message_id):
-    """Get video from database"""
+# ===================== VIDEO SHORT CODES =====================
+# Every video gets a number from the 'videos' sequence and a code "v" +
+# base62(number), e.g. v1, v2z. Codes are unique across channels.
+# Old links that use the raw message id (all digits) still work.
+BASE62 = string.digits + string.ascii_lowercase + string.ascii_uppercase
+VIDEO_CODE_PATTERN = re.compile(r'^(v[0-9A-Za-z]{1,11}|\d{1,12})$')
+
+def base62(number):
+    """Encode a non-negative integer in base62"""
+    digits = []
+    while True:
+        number, remainder = divmod(number, 62)
+        digits.append(BASE62[remainder])
+        if number == 0:
+            return ''.join(reversed(digits))
+
+def video_code(seq):
+    """Short code of the video with this sequence number"""
+    return 'v' + base62(seq)
+
+def reserve_sequence(name, count=1):
+    """Reserve `count` consecutive numbers of a sequence; returns the first"""
+    counter = counters_col.find_one_and_update(
+        {'_id': name},
+        {'$inc': {'value': count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter['value'] - count + 1
+
+def backfill_video_codes():
+    """Give a code to videos saved before codes existed (oldest first)"""
     try:
-        return videos_col.find_one({'message_id': int(message_id)})
+        missing = list(videos_col.find({'code': {'$exists': False}}, {'_id': 1}).sort('_id', ASCENDING))
+        if not missing:
+            return 0
+        first_seq = reserve_sequence('videos', len(missing))
+        videos_col.bulk_write([
+            UpdateOne(
+                {'_id': doc['_id']},
+                {'$set': {'seq': first_seq + i, 'code': video_code(first_seq + i)}}
+            )
+            for i, doc in enumerate(missing)
+        ], ordered=False)
+        logger.info("🔤 Assigned short codes to %s videos", len(missing))
+        return len(missing)
     except Exception as e:
-        logger.error(f"Error getting video: {e}")
-        return None
+        logger.error("Error backfilling video codes: %s", e)
+        return 0
 
-def increment_video_view(message_id):
-    """Increment video view count"""
+@run_in_db_executor
+def fetch_video(code):
+    """Get video by short code, or by message id for old numeric links"""
     try:
-        videos_col.update_one(
-            {'message_id': int(message_id)},
-            {'$inc': {'views': 1}}
-        )
+        if code.isdigit():
+            return videos_col.find_one({'message_id': int(code)})
+        return videos_col.find_one({'code': code})
     except Exception as e:
-        logger.error(f"Error incrementing view: {e}")
+        logger.error("Error getting video: %s", e)
+        return None
+
+async def get_video(code):
+    """Get video by short code (served from video_cache when possible)"""
+    if not VIDEO_CODE_PATTERN.match(code):
+        return None
+    video = video_cache.get(code)
+    cache_requests.inc('video', 'miss' if video is None else 'hit')
+    if video is None:
+        video = await fetch_video(code)
+        if video is None:
+            video_cache.set(code, VIDEO_NOT_FOUND, VIDEO_NEGATIVE_TTL)
+        else:
+            video_cache.set(code, video, VIDEO_CACHE_TTL)
+    return None if video is VIDEO_NOT_FOUND else video
 
+def increment_video_view(video):
+    """Increment video view count (written in batches by view_counter)"""
+    view_counter.add(video['channel_id'], video['message_id'], video.get('code'))
+    search_index.add_views(video.get('code'))
+    trending.record(video.get('code'))
+
+@run_in_db_executor
 def add_force_join_channel(channel_id, username):
     """Add force join channel"""
     try:
+        now = datetime.utcnow()
         channel_data = {
             'channel_id': channel_id,
             'username': username.replace('@', ''),
-            'added_at': datetime.utcnow(),
-            'is_active': True
+            'added_at': now,
+            'is_active': True,
+            # Membership index entries written before this are not trusted
+            'index_since': now
         }
         force_join_col.update_one(
             {'channel_id': channel_id},
             {'$set': channel_data},
             upsert=True
         )
-        logger.info(f"✅ Force join channel added: @{username}")
+        config_cache.reload_channels()
+        publish_event.sync('config')
+        logger.info("✅ Force join channel added: @%s", username)
         return True
     except Exception as e:
-        logger.error(f"Error adding force join channel: {e}")
+        logger.error("Error adding force join channel: %s", e)
         return False
 
+@run_in_db_executor
 def remove_force_join_channel(channel_id):
     """Remove force join channel"""
     try:
         result = force_join_col.delete_one({'channel_id': channel_id})
+        memberships_col.delete_many({'channel_id': channel_id})
+        config_cache.reload_channels()
+        publish_event.sync('config')
         return result.deleted_count > 0
     except Exception as e:
-        logger.error(f"Error removing force join channel: {e}")
+        logger.error("Error removing force join channel: %s", e)
         return False
 
-def get_force_join_channels():
-    """Get all active force join channels"""
+@run_in_db_executor
+def fetch_force_join_channels():
+    """Get all active force join channels from database"""
     try:
         return list(force_join_col.find({'is_active': True}))
     except Exception as e:
-        logger.error(f"Error getting force join channels: {e}")
+        logger.error("Error getting force join channels: %s", e)
         return []
 
-def save_user(user_id, username, first_name):
-    """Save user to database"""
+async def get_force_join_channels():
+    """Get all active force join channels (from the config cache once it is loaded)"""
+    if config_cache.loaded:
+        return list(config_cache.channels)
+    return await fetch_force_join_channels()
+
+@run_in_db_executor
+def lookup_memberships(user_id, channels):
+    """Get trusted membership index entries for user: {channel_id: is_member}"""
     try:
-        user_data = {
+        oldest = datetime.utcnow() - timedelta(days=MEMBERSHIP_INDEX_MAX_AGE_DAYS)
+        trusted_since = {
+            ch['channel_id']: max(ch.get('index_since') or oldest, oldest)
+            for ch in channels
+        }
+        docs = memberships_col.find({
             'user_id': user_id,
-            'username': username,
-            'first_name': first_name,
-            'last_active': datetime.utcnow()
+            'channel_id': {'$in': list(trusted_since)}
+        })
+        return {
+            doc['channel_id']: doc['is_member']
+            for doc in docs
+            if doc['updated_at'] >= trusted_since[doc['channel_id']]
         }
-        users_col.update_one(
-            {'user_id': user_id},
-            {'$set': user_data, '$setOnInsert': {'first_seen': datetime.utcnow()}},
+    except Exception as e:
+        logger.error("Error reading membership index: %s", e)
+        return {}
+
+@run_in_db_executor
+def record_membership(channel_id, user_id, is_member, status, publish=False):
+    """Store a membership result in the index (publish: also tell the other replicas)"""
+    try:
+        memberships_col.update_one(
+            {'channel_id': channel_id, 'user_id': user_id},
+            {'$set': {
+                'is_member': is_member,
+                'status': status,
+                'updated_at': datetime.utcnow()
+            }},
             upsert=True
         )
+        if publish:
+            publish_event.sync('membership', [channel_id, user_id, is_member])
     except Exception as e:
-        logger.error(f"Error saving user: {e}")
+        logger.error("Error writing membership index: %s", e)
 
-def get_stats():
-    """Get bot statistics"""
+@run_in_db_executor
+def reconcile_membership_index():
+    """Distrust the membership index if the bot was down too long.
+
+    Telegram keeps undelivered updates for 24 hours, so after a shorter
+    outage the missed chat_member updates still arrive. After a longer
+    one every channel's index is reset and rebuilt lazily from live checks.
+    """
     try:
-        return {
-            'users': users_col.count_documents({}),
-            'videos': videos_col.count_documents({}),
-            'force_join': force_join_col.count_documents({'is_active': True})
-        }
+        now = datetime.utcnow()
+        heartbeat = settings_col.find_one({'key': 'membership_index_heartbeat'})
+        if not heartbeat or now - heartbeat['value'] > timedelta(hours=MEMBERSHIP_UPDATE_RETENTION_HOURS):
+            force_join_col.update_many({}, {'$set': {'index_since': now}})
+            logger.info("🔄 Membership index reset after downtime")
+    except Exception as e:
+        logger.error("Error reconciling membership index: %s", e)
+
+@run_in_db_executor
+def touch_membership_heartbeat():
+    """Record that the bot is receiving chat_member updates"""
+    try:
+        settings_col.update_one(
+            {'key': 'membership_index_heartbeat'},
+            {'$set': {'value': datetime.utcnow()}},
+            upsert=True
+        )
     except Exception as e:
-        logger.error(f"Error getting stats: {e}")
-        return {'users': 0, 'videos': 0, 'force_join': 0}
+        logger.error("Error writing membership heartbeat: %s", e)
+
+async def membership_heartbeat_periodically():
+    """Background job: write the membership index heartbeat"""
+    while True:
+        if leader.is_leader:
+            await touch_membership_heartbeat()
+        await asyncio.sleep(MEMBERSHIP_HEARTBEAT_INTERVAL)
+
+def save_user(user_id, username, first_name):
+    """Save user to database (written in batches by user_activity)"""
+    user_activity.add(user_id, username, first_name)
+
+def get_stats():
+    """Get bot statistics (from the live counters, no DB calls)"""
+    today = day_key(datetime.utcnow())
+    active_today, new_today = live_stats.daily.get(today, (0, 0))
+    return {
+        'users': live_stats.totals['users'],
+        'videos': live_stats.totals['videos'],
+        'force_join': len(config_cache.channels),
+        'active_today': active_today,
+        'new_today': new_today,
+        'daily': dict(live_stats.daily)
+    }
 
 # ===================== ADMIN PANEL KEYBOARDS =====================
 
@@ -360,6 +2150,10 @@ def admin_main_keyboard():
             InlineKeyboardButton("⚙️ Settings", callback_data="admin_settings"),
             InlineKeyboardButton("📊 Statistics", callback_data="admin_stats")
         ],
+        [
+            InlineKeyboardButton("📣 Broadcast", callback_data="admin_broadcast"),
+            InlineKeyboardButton("📈 Metrics", callback_data="admin_metrics")
+        ],
         [
             InlineKeyboardButton("🔄 Refresh", callback_data="admin_refresh"),
             InlineKeyboardButton("❌ Close", callback_data="admin_close")
@@ -367,9 +2161,9 @@ def admin_main_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
-def channel_manager_keyboard():
+async def channel_manager_keyboard():
     """Channel manager keyboard"""
-    channels = get_force_join_channels()
+    channels = await get_force_join_channels()
     keyboard = []
     
     for ch in channels:
@@ -407,12 +2201,448 @@ def settings_keyboard():
         [InlineKeyboardButton("🎮 Mini App URL", callback_data="setting_mini_app")],
         [InlineKeyboardButton("📢 Main Channel", callback_data="setting_main_channel")],
         [InlineKeyboardButton("🔒 Video Protection", callback_data="setting_protection")],
+        [InlineKeyboardButton("📦 Delivery Mode", callback_data="toggle_delivery_mode")],
         [InlineKeyboardButton("🤖 Bot Name", callback_data="setting_bot_name")],
         [InlineKeyboardButton("🔙 Back", callback_data="admin_main")]
     ]
     return InlineKeyboardMarkup(keyboard)
 
+# ===================== FORCE JOIN CHECK =====================
+# Membership is resolved in three tiers: the in-memory cache, the
+# channel_members index (kept current by chat_member updates), and
+# finally a live get_chat_member call for users the index has not seen.
+
+def cache_membership(channel_id, user_id, joined):
+    """Put a membership result in the in-memory cache"""
+    membership_cache.set(
+        (user_id, channel_id), joined,
+        MEMBERSHIP_TTL if joined else MEMBERSHIP_NEGATIVE_TTL
+    )
+
+async def check_membership_live(bot, channel_id, user_id):
+    """Ask Telegram if user joined channel and record the answer"""
+    try:
+        member = await bot.get_chat_member(channel_id, user_id)
+    except Exception as e:
+        # Errors are not cached, the next request asks Telegram again
+        logger.error("Error checking membership: %s", e)
+        return False
+    
+    joined = member.status not in ['left', 'kicked']
+    cache_membership(channel_id, user_id, joined)
+    run_in_background(record_membership(channel_id, user_id, joined, str(member.status)))
+    return joined
+
+async def get_unjoined_channels(bot, user_id, channels, recheck_negative=False):
+    """Return the channels the user has not joined.
+
+    With recheck_negative, "not joined" answers from the cache and the
+    index are verified again with Telegram.
+    """
+    known = {}
+    for ch in channels:
+        cached = membership_cache.get((user_id, ch['channel_id']))
+        if cached is True or (cached is False and not recheck_negative):
+            known[ch['channel_id']] = cached
+            membership_checks.inc('cache')
+    cache_requests.inc('membership', 'hit', amount=len(known))
+    cache_requests.inc('membership', 'miss', amount=len(channels) - len(known))
+    
+    unknown = [ch for ch in channels if ch['channel_id'] not in known]
+    if unknown:
+        for channel_id, joined in (await lookup_memberships(user_id, unknown)).items():
+            if joined or not recheck_negative:
+                known[channel_id] = joined
+                cache_membership(channel_id, user_id, joined)
+                membership_checks.inc('index')
+    
+    live = [ch for ch in channels if ch['channel_id'] not in known]
+    if live:
+        membership_checks.inc('live', amount=len(live))
+    results = await asyncio.gather(*(
+        check_membership_live(bot, ch['channel_id'], user_id) for ch in live
+    ))
+    known.update(zip((ch['channel_id'] for ch in live), results))
+    
+    return [ch for ch in channels if not known[ch['channel_id']]]
+
+@instrumented('chat_member')
+async def track_channel_membership(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Keep the membership index current from chat_member updates"""
+    change = update.chat_member
+    channel_ids = {ch['channel_id'] for ch in await get_force_join_channels()}
+    if change.chat.id not in channel_ids:
+        return
+    
+    status = change.new_chat_member.status
+    joined = status not in ['left', 'kicked']
+    user_id = change.new_chat_member.user.id
+    cache_membership(change.chat.id, user_id, joined)
+    await record_membership(change.chat.id, user_id, joined, str(status), publish=True)
+
+async def bot_is_channel_admin(bot, channel_id):
+    """Check the bot can see chat_member updates for channel"""
+    try:
+        member = await bot.get_chat_member(channel_id, bot.id)
+        return member.status in ['administrator', 'creator']
+    except TelegramError as e:
+        logger.error("Error checking bot rights in %s: %s", channel_id, e)
+        return False
+
+# ===================== BROADCAST ENGINE =====================
+# A broadcast is a document in broadcasts_col. Users are walked in
+# user_id order in small batches and progress (last_user_id + counters)
+# is saved after every batch, so a restart resumes where it stopped.
+running_broadcasts = {}
+
+@run_in_db_executor
+def create_broadcast(from_chat_id, message_id):
+    """Create a broadcast and return its id"""
+    try:
+        result = broadcasts_col.insert_one({
+            'from_chat_id': from_chat_id,
+            'message_id': message_id,
+            'status': 'running',
+            'last_user_id': None,
+            'sent': 0,
+            'failed': 0,
+            'blocked': 0,
+            'started_at': datetime.utcnow(),
+            'updated_at': datetime.utcnow()
+        })
+        return result.inserted_id
+    except Exception as e:
+        logger.error("Error creating broadcast: %s", e)
+        return None
+
+@run_in_db_executor
+def get_broadcast(broadcast_id):
+    """Get broadcast from database"""
+    try:
+        return broadcasts_col.find_one({'_id': broadcast_id})
+    except Exception as e:
+        logger.error("Error getting broadcast: %s", e)
+        return None
+
+@run_in_db_executor
+def get_running_broadcast_ids():
+    """Ids of broadcasts that were running when the bot stopped"""
+    try:
+        return [doc['_id'] for doc in broadcasts_col.find({'status': 'running'}, {'_id': 1})]
+    except Exception as e:
+        logger.error("Error getting running broadcasts: %s", e)
+        return []
+
+@run_in_db_executor
+def set_broadcast_status(broadcast_id, status):
+    """Mark broadcast done/cancelled"""
+    try:
+        broadcasts_col.update_one(
+            {'_id': broadcast_id},
+            {'$set': {'status': status, 'updated_at': datetime.utcnow()}}
+        )
+    except Exception as e:
+        logger.error("Error updating broadcast: %s", e)
+
+@run_in_db_executor
+def fetch_broadcast_batch(last_user_id, limit):
+    """Next user ids after last_user_id, skipping blocked users"""
+    try:
+        query = {'blocked': {'$ne': True}}
+        if last_user_id is not None:
+            query['user_id'] = {'$gt': last_user_id}
+        cursor = users_col.find(query, {'_id': 0, 'user_id': 1}).sort('user_id', ASCENDING).limit(limit)
+        return [doc['user_id'] for doc in cursor]
+    except Exception as e:
+        logger.error("Error reading broadcast users: %s", e)
+        return None
+
+@run_in_db_executor
+def save_broadcast_progress(broadcast_id, last_user_id, counts, blocked_user_ids):
+    """Checkpoint a finished batch and mark users who blocked the bot"""
+    try:
+        if blocked_user_ids:
+            users_col.update_many(
+                {'user_id': {'$in': blocked_user_ids}},
+                {'$set': {'blocked': True}}
+            )
+        broadcasts_col.update_one(
+            {'_id': broadcast_id},
+            {
+                '$set': {'last_user_id': last_user_id, 'updated_at': datetime.utcnow()},
+                '$inc': {
+                    'sent': counts.get('sent', 0),
+                    'failed': counts.get('failed', 0),
+                    'blocked': counts.get('blocked', 0)
+                }
+            }
+        )
+        return True
+    except Exception as e:
+        logger.error("Error saving broadcast progress: %s", e)
+        return False
+
+async def broadcast_to_user(bot, bucket, broadcast, user_id):
+    """Copy the broadcast message to one user: 'sent', 'blocked' or 'failed'
+
+    Flood waits and network retries are handled by the outbound scheduler.
+    """
+    await bucket.acquire()
+    try:
+        await bot.copy_message(
+            chat_id=user_id,
+            from_chat_id=broadcast['from_chat_id'],
+            message_id=broadcast['message_id']
+        )
+        return 'sent'
+    except Forbidden:
+        return 'blocked'
+    except BadRequest as e:
+        if "chat not found" in str(e).lower():
+            return 'blocked'
+        return 'failed'
+    except TelegramError as e:
+        logger.error("Error broadcasting to %s: %s", user_id, e)
+        return 'failed'
+
+@in_lane(PRIORITY_BULK)
+async def run_broadcast(bot, broadcast_id):
+    """Send a broadcast to every user, resuming from its last checkpoint"""
+    bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    
+    async def send(broadcast, user_id):
+        async with semaphore:
+            return user_id, await broadcast_to_user(bot, bucket, broadcast, user_id)
+    
+    try:
+        while True:
+            # Re-read every batch so a stop from the admin panel is seen quickly
+            broadcast = await get_broadcast(broadcast_id)
+            if not broadcast or broadcast['status'] != 'running':
+                return
+            totals = Counter({key: broadcast.get(key, 0) for key in ('sent', 'blocked', 'failed')})
+            
+            user_ids = await fetch_broadcast_batch(broadcast['last_user_id'], BROADCAST_BATCH_SIZE)
+            if user_ids is None:
+                await asyncio.sleep(5)
+                continue
+            if not user_ids:
+                break
+            
+            results = await asyncio.gather(*(send(broadcast, uid) for uid in user_ids))
+            counts = Counter(result for _, result in results)
+            blocked = [uid for uid, result in results if result == 'blocked']
+            while not await save_broadcast_progress(broadcast_id, user_ids[-1], counts, blocked):
+                await asyncio.sleep(5)
+            totals.update(counts)
+        
+        await set_broadcast_status(broadcast_id, 'done')
+        # The counters kept here if the final read fails
+        broadcast = await get_broadcast(broadcast_id) or totals
+        await bot.send_message(
+            chat_id=ADMIN_ID,
+            text=(
+                "📣 Broadcast finished!\n\n"
+                f"✅ Sent: {broadcast['sent']}\n"
+                f"🚫 Blocked: {broadcast['blocked']}\n"
+                f"❌ Failed: {broadcast['failed']}"
+            )
+        )
+    finally:
+        running_broadcasts.pop(broadcast_id, None)
+
+def launch_broadcast(bot, broadcast_id):
+    """Start the runner for a broadcast unless it is already running.
+
+    Only the leader sends broadcasts; on other replicas the leader picks
+    the new broadcast up within a few seconds (see LeaderLease).
+    """
+    if leader.is_leader and broadcast_id not in running_broadcasts:
+        running_broadcasts[broadcast_id] = start_background_task(run_broadcast(bot, broadcast_id))
+
+async def resume_broadcasts(bot):
+    """Start runners for broadcasts that are running but not sent by this process"""
+    for broadcast_id in await get_running_broadcast_ids():
+        if broadcast_id not in running_broadcasts:
+            logger.info("📣 Resuming broadcast %s", broadcast_id)
+            launch_broadcast(bot, broadcast_id)
+
+def stop_local_broadcasts():
+    """Stop sending broadcasts (after losing the leader lease); progress is saved per batch"""
+    for task in list(running_broadcasts.values()):
+        task.cancel()
+
+# ===================== SEARCH INDEX =====================
+# Inverted index over captions and channel names, kept in memory.
+# Terms are kept in a sorted list so a prefix is a bisect range; results
+# are ranked by views. Loaded from MongoDB at startup and updated as
+# videos are ingested.
+SEARCH_TOKEN_PATTERN = re.compile(r'[\w\u0980-\u09FF]+')
+# Bengali digits -> ASCII digits, zero-width (non-)joiners removed
+SEARCH_NORMALIZE = {ord(c): str(i) for i, c in enumerate('০১২৩৪৫৬৭৮৯')}
+SEARCH_NORMALIZE.update({0x200C: None, 0x200D: None})
+SEARCH_MIN_PREFIX = 2
+SEARCH_RESULTS = 50
+# Above SEARCH_SET_LIMIT candidates, walk videos by views (at most SEARCH_SCAN_LIMIT)
+SEARCH_SET_LIMIT = 3000
+SEARCH_SCAN_LIMIT = 20000
+SEARCH_RANK_REFRESH = 60
+
+def search_tokens(text):
+    """Split Bangla/English text into normalized search terms"""
+    if not text:
+        return []
+    return SEARCH_TOKEN_PATTERN.findall(text.translate(SEARCH_NORMALIZE).casefold())
+
+class SearchIndex:
+    """In-memory inverted index: term -> set of video codes.
+
+    Small result sets are collected from the postings and ranked by live
+    view counts. When every query word is very common, the videos are
+    instead walked in view order (re-sorted at most every
+    SEARCH_RANK_REFRESH seconds) until enough matches are found.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.terms = []
+        self.doc_terms = {}
+        self.views = {}
+        self.videos = {}
+        self.ranked = []
+        self.ranked_at = 0
+
+    @staticmethod
+    def entry(video):
+        """The fields search results are shown with"""
+        return {
+            'code': video['code'],
+            'caption': video.get('caption'),
+            'channel_name': video.get('channel_name'),
+            'media_type': video.get('media_type'),
+            'duration': video.get('duration'),
+        }
+
+    @staticmethod
+    def video_terms(video):
+        return frozenset(search_tokens(video.get('caption')) + search_tokens(video.get('channel_name')))
+
+    def load(self, videos):
+        """Replace the index with these videos (built off to the side, then swapped in)"""
+        postings, doc_terms, views, entries = {}, {}, {}, {}
+        for video in videos:
+            code = video['code']
+            entries[code] = self.entry(video)
+            views[code] = video.get('views', 0)
+            doc_terms[code] = terms = self.video_terms(video)
+            for term in terms:
+                postings.setdefault(term, set()).add(code)
+        ranked = sorted(views, key=views.get, reverse=True)
+        self.postings, self.doc_terms, self.views, self.videos = postings, doc_terms, views, entries
+        self.terms = sorted(postings)
+        self.ranked, self.ranked_at = ranked, time.monotonic()
+
+    def add(self, video):
+        """Add or update one video"""
+        code = video['code']
+        for term in self.doc_terms.get(code, ()):
+            self.postings[term].discard(code)
+        if code not in self.videos:
+            self.ranked.append(code)
+        
+        self.videos[code] = self.entry(video)
+        self.views.setdefault(code, video.get('views', 0))
+        self.doc_terms[code] = terms = self.video_terms(video)
+        for term in terms:
+            codes = self.postings.get(term)
+            if codes is None:
+                codes = self.postings[term] = set()
+                bisect.insort(self.terms, term)
+            codes.add(code)
+
+    def add_views(self, code, count=1):
+        if code in self.views:
+            self.views[code] += count
+
+    def term_range(self, token, prefix):
+        """Terms a query word matches: itself, or every term it is a prefix of"""
+        if not prefix or len(token) < SEARCH_MIN_PREFIX:
+            return [token] if token in self.postings else []
+        start = bisect.bisect_left(self.terms, token)
+        end = bisect.bisect_left(self.terms, token + '\U0010ffff', start)
+        return self.terms[start:end]
+
+    @staticmethod
+    def has_word(terms, token, prefix):
+        if token in terms:
+            return True
+        return prefix and len(token) >= SEARCH_MIN_PREFIX and any(t.startswith(token) for t in terms)
+
+    def search(self, query, limit=SEARCH_RESULTS, offset=0):
+        """Videos matching every word of the query (the last word as a prefix), most viewed first"""
+        tokens = search_tokens(query)
+        words = [(token, i == len(tokens) - 1) for i, token in enumerate(tokens)]
+        
+        if time.monotonic() - self.ranked_at > SEARCH_RANK_REFRESH:
+            self.ranked = sorted(self.views, key=self.views.get, reverse=True)
+            self.ranked_at = time.monotonic()
+        if not words:
+            return [self.videos[code] for code in self.ranked[offset:offset + limit]]
+        
+        # Start from the word with the fewest matching videos
+        plans = []
+        for token, prefix in words:
+            terms = self.term_range(token, prefix)
+            if not terms:
+                return []
+            plans.append((sum(len(self.postings[t]) for t in terms), token, prefix, terms))
+        plans.sort(key=lambda plan: plan[0])
+        size, _, _, terms = plans[0]
+        rest = [(token, prefix) for _, token, prefix, _ in plans[1:]]
+        
+        def matches(code):
+            doc_terms = self.doc_terms[code]
+            return all(self.has_word(doc_terms, token, prefix) for token, prefix in rest)
+        
+        wanted = offset + limit
+        if size <= SEARCH_SET_LIMIT:
+            candidates = set()
+            for term in terms:
+                candidates |= self.postings[term]
+            top = heapq.nlargest(wanted, filter(matches, candidates), key=lambda code: self.views.get(code, 0))
+        else:
+            first = plans[0][1:3]
+            top = []
+            for code in itertools.islice(self.ranked, SEARCH_SCAN_LIMIT):
+                if self.has_word(self.doc_terms[code], *first) and matches(code):
+                    top.append(code)
+                    if len(top) == wanted:
+                        break
+        return [self.videos[code] for code in top[offset:]]
+
+    def __len__(self):
+        return len(self.videos)
+
+search_index = SearchIndex()
+
+@run_in_db_executor
+def load_search_index():
+    """Rebuild the search index from the videos collection"""
+    try:
+        videos = videos_col.find(
+            {'code': {'$exists': True}},
+            {'_id': 0, 'code': 1, 'caption': 1, 'channel_name': 1, 'media_type': 1, 'duration': 1, 'views': 1}
+        )
+        search_index.load(videos)
+        logger.info("🔎 Search index loaded: %s videos, %s terms", len(search_index), len(search_index.terms))
+        return True
+    except Exception as e:
+        logger.error("Error loading search index: %s", e)
+        return False
+
 # ===================== START COMMAND =====================
+@instrumented('start')
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
     user = update.effective_user
@@ -425,8 +2655,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Get settings
-    mini_app_url = get_setting('mini_app_url', DEFAULT_SETTINGS['mini_app_url'])
-    main_channel = get_setting('main_channel_username', DEFAULT_SETTINGS['main_channel_username'])
+    mini_app_url = await get_setting('mini_app_url', DEFAULT_SETTINGS['mini_app_url'])
+    main_channel = await get_setting('main_channel_username', DEFAULT_SETTINGS['main_channel_username'])
     
     # Welcome message
     keyboard = [
@@ -435,7 +2665,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("❓ Help", callback_data="help")]
     ]
     
-    welcome_text = get_message('welcome').format(name=user.first_name)
+    welcome_text = (await get_message('welcome')).format(name=user.first_name)
     
     try:
         await update.message.reply_text(
@@ -444,44 +2674,163 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode=ParseMode.MARKDOWN
         )
     except Exception as e:
-        logger.error(f"Error sending welcome message: {e}")
+        logger.error("Error sending welcome message: %s", e)
 
 # ===================== VIDEO REQUEST HANDLER =====================
-async def handle_video_request(update: Update, context: ContextTypes.DEFAULT_TYPE, video_id: str):
-    """Handle video playback request"""
+# (user_id, requested code) -> outcome of a recent request
+recent_video_requests = TTLCache(USER_RECENT_CACHE_SIZE)
+# (user_id, requested code) -> future with the outcome of a request still running.
+# Video requests skip per-user ordering (update_order_key), so repeated taps
+# arrive here while the first one runs and are answered from it.
+video_requests_in_flight = {}
+# Seconds a repeated "Joined" tap waits for the running request before it is answered anyway
+REPEAT_ANSWER_TIMEOUT = 10
+
+REPEAT_ANSWERS = {
+    'delivered': "✅ ভিডিওটি পাঠানো হয়েছে!\nAlready sent - scroll up ⬆️",
+    'force_join': "📢 আগে সব চ্যানেলে জয়েন করুন!\nPlease join all channels first, then tap again.",
+}
+
+def is_video_request(update):
+    """Deep links and "Joined" taps, which handle_video_request coalesces itself"""
+    if update.callback_query:
+        return (update.callback_query.data or '').startswith('verify_')
+    message = update.message
+    return bool(message and message.text and message.text.startswith('/start '))
+
+def remember_video_request(user_id, video_id, outcome):
+    window = VIDEO_REPEAT_WINDOW if outcome == 'delivered' else FORCE_JOIN_REPEAT_WINDOW
+    recent_video_requests.set((user_id, video_id), outcome, window)
+
+async def answer_when_done(query, pending):
+    """Answer a repeated "Joined" tap once the request it repeats has finished"""
+    try:
+        outcome = await asyncio.wait_for(asyncio.shield(pending), REPEAT_ANSWER_TIMEOUT)
+    except asyncio.TimeoutError:
+        outcome = None
+    try:
+        if outcome in REPEAT_ANSWERS:
+            await query.answer(REPEAT_ANSWERS[outcome], show_alert=True)
+        else:
+            await query.answer()
+    except TelegramError as e:
+        logger.debug("Could not answer repeated tap: %s", e)
+
+async def send_video_file(bot, chat_id, video, protect):
+    """Send a video by its stored file_id with the matching send method"""
+    media_type = video.get('media_type', 'document')
+    send = {
+        'video': bot.send_video,
+        'animation': bot.send_animation,
+        'document': bot.send_document,
+    }[media_type]
+    await send(
+        chat_id,
+        video['file_id'],
+        caption=video.get('caption'),
+        protect_content=protect
+    )
+
+class VideoUnavailable(BadRequest):
+    """Every delivery method failed for a video (e.g. its source message is gone)"""
+
+async def deliver_video(bot, chat_id, video, protect, mode):
+    """Send a video to a user by copy or by file_id.
+
+    If the preferred way fails (e.g. the bot lost access to the source
+    channel), the other one is tried when the video has a file_id. When
+    all of them fail, VideoUnavailable carries every error. Forbidden
+    (the user blocked the bot) is raised at once.
+    """
+    methods = ['copy']
+    if video.get('file_id'):
+        methods = ['file_id', 'copy'] if mode == 'file_id' else ['copy', 'file_id']
+    
+    errors = []
+    for i, method in enumerate(methods):
+        try:
+            if method == 'file_id':
+                await send_video_file(bot, chat_id, video, protect)
+            else:
+                await bot.copy_message(
+                    chat_id=chat_id,
+                    from_chat_id=video['channel_id'],
+                    message_id=video['message_id'],
+                    protect_content=protect
+                )
+            return
+        except BadRequest as e:
+            errors.append(f"{method}: {e}")
+            if i == len(methods) - 1:
+                raise VideoUnavailable('; '.join(errors)) from e
+            logger.warning("⚠️ Delivery by %s failed for %s: %s, trying %s", method, video.get('code'), e, methods[i + 1])
+
+@instrumented('video_request')
+@in_lane(PRIORITY_DELIVERY)
+async def handle_video_request(update: Update, context: ContextTypes.DEFAULT_TYPE, video_id: str,
+                               recheck_membership: bool = False):
+    """Handle video playback request
+
+    recheck_membership is set when the user taps "Joined", so cached
+    "not joined" results are verified again with Telegram. The same request
+    again while it runs, or soon after, is answered from the first one.
+    """
     user = update.effective_user
-    chat_id = update.effective_chat.id
+    query = update.callback_query
+    key = (user.id, video_id)
     
-    try:
-        message_id = int(video_id)
-    except ValueError:
-        await update.message.reply_text(
-            get_message('video_not_found'),
-            parse_mode=ParseMode.MARKDOWN
-        )
+    # The same request again within its window: answer without DB work
+    repeat = recent_video_requests.get(key)
+    if repeat is not None:
+        set_outcome('repeat')
+        if query:
+            await query.answer(REPEAT_ANSWERS[repeat], show_alert=True)
+        else:
+            await update.effective_message.reply_text(REPEAT_ANSWERS[repeat])
+        return
+    
+    # Still running: the first request's reply is on its way, so a repeated
+    # deep link needs nothing; a "Joined" tap is answered when it finishes
+    pending = video_requests_in_flight.get(key)
+    if pending is not None:
+        set_outcome('coalesced')
+        if query:
+            run_in_background(answer_when_done(query, pending))
         return
     
-    # Get video from database
-    video = get_video(message_id)
+    pending = video_requests_in_flight[key] = asyncio.get_running_loop().create_future()
+    outcome = 'error'
+    try:
+        if query:
+            await query.answer()
+        outcome = await serve_video_request(update, context, video_id, recheck_membership)
+    finally:
+        del video_requests_in_flight[key]
+        pending.set_result(outcome)
+    set_outcome(outcome)
+    if outcome in REPEAT_ANSWERS:
+        remember_video_request(user.id, video_id, outcome)
+
+async def serve_video_request(update, context, video_id, recheck_membership):
+    """Find the video, check force join and deliver it; returns the outcome"""
+    user = update.effective_user
+    chat_id = update.effective_chat.id
+    message = update.effective_message
+    
+    # Get video (short code, or message id for old links)
+    video = await get_video(video_id)
     if not video:
-        await update.message.reply_text(
-            get_message('video_not_found'),
+        await message.reply_text(
+            await get_message('video_not_found'),
             parse_mode=ParseMode.MARKDOWN
         )
-        return
+        return 'not_found'
     
     # Check force join channels
-    force_channels = get_force_join_channels()
-    not_joined = []
-    
-    for channel in force_channels:
-        try:
-            member = await context.bot.get_chat_member(channel['channel_id'], user.id)
-            if member.status in ['left', 'kicked']:
-                not_joined.append(channel)
-        except Exception as e:
-            logger.error(f"Error checking membership: {e}")
-            not_joined.append(channel)
+    force_channels = await get_force_join_channels()
+    not_joined = await get_unjoined_channels(
+        context.bot, user.id, force_channels, recheck_membership
+    )
     
     if not_joined:
         # User hasn't joined all channels
@@ -496,83 +2845,136 @@ async def handle_video_request(update: Update, context: ContextTypes.DEFAULT_TYP
             callback_data=f"verify_{video_id}"
         )])
         
-        await update.message.reply_text(
-            get_message('force_join'),
+        await message.reply_text(
+            await get_message('force_join'),
             reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode=ParseMode.MARKDOWN
         )
-        return
+        return 'force_join'
     
     # User joined all channels - send video
+    message_id = video['message_id']
     try:
-        protect = get_setting('video_protection', True)
+        protect = await get_setting('video_protection', True)
+        delivery_mode = await get_setting('delivery_mode', DEFAULT_SETTINGS['delivery_mode'])
         
-        await context.bot.copy_message(
-            chat_id=chat_id,
-            from_chat_id=video['channel_id'],
-            message_id=message_id,
-            protect_content=protect
-        )
+        await deliver_video(context.bot, chat_id, video, protect, delivery_mode)
         
-        increment_video_view(message_id)
+        increment_video_view(video)
+        record_coview(user.id, video.get('code'))
         
         # After video message
-        mini_app_url = get_setting('mini_app_url', DEFAULT_SETTINGS['mini_app_url'])
-        keyboard = [[InlineKeyboardButton("🔙 Back to App", web_app={"url": mini_app_url})]]
+        mini_app_url = await get_setting('mini_app_url', DEFAULT_SETTINGS['mini_app_url'])
+        keyboard = watch_next_buttons(context.bot.username, video.get('code'))
+        keyboard.append([InlineKeyboardButton("🔙 Back to App", web_app={"url": mini_app_url})])
         
-        await update.message.reply_text(
-            get_message('after_video'),
+        await message.reply_text(
+            await get_message('after_video'),
             reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode=ParseMode.MARKDOWN
         )
         
-        logger.info(f"✅ Video sent to user {user.id}: {message_id}")
+        logger.info("✅ Video sent to user %s: %s", user.id, message_id)
+        return 'delivered'
+        
+    except VideoUnavailable as e:
+        logger.warning("⚠️ Video %s could not be delivered: %s", video.get('code'), e)
+        await message.reply_text(
+            await get_message('video_not_found'),
+            parse_mode=ParseMode.MARKDOWN
+        )
+        return 'not_found'
+    except TelegramError as e:
+        # Flood waits and retryable network errors were already retried by the scheduler
+        logger.error("Error sending video: %s", e)
+        return 'error'
+
+# ===================== INLINE SEARCH HANDLER =====================
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+@instrumented('inline_query')
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Search videos with @bot <words> in any chat"""
+    query = update.inline_query
+    try:
+        offset = int(query.offset or 0)
+    except ValueError:
+        offset = 0
+    
+    videos = search_index.search(query.query, SEARCH_RESULTS, offset)
+    bot_username = context.bot.username
+    
+    results = []
+    for video in videos:
+        link = f"https://t.me/{bot_username}?start={video['code']}"
+        caption = (video['caption'] or '').strip()
+        title = caption.split('\n')[0][:64] if caption else f"🎬 {video['channel_name']} · {video['code']}"
+        details = [video['channel_name'] or '']
+        if video['duration']:
+            details.append(format_duration(video['duration']))
         
-    except BadRequest as e:
-        if "message to copy not found" in str(e).lower():
-            await update.message.reply_text(
-                get_message('video_not_found'),
-                parse_mode=ParseMode.MARKDOWN
-            )
-        else:
-            logger.error(f"Error sending video: {e}")
+        results.append(InlineQueryResultArticle(
+            id=video['code'],
+            title=title,
+            description=' · '.join(details),
+            input_message_content=InputTextMessageContent(f"🎬 {title}\n\n▶️ {link}"),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("▶️ Watch", url=link)]])
+        ))
+    
+    await query.answer(
+        results,
+        cache_time=30,
+        next_offset=str(offset + SEARCH_RESULTS) if len(videos) == SEARCH_RESULTS else ''
+    )
 
 # ===================== CALLBACK QUERY HANDLER =====================
+@instrumented('button_callback')
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle button callbacks"""
     query = update.callback_query
-    await query.answer()
-    
     data = query.data
     user_id = query.from_user.id
     
+    # Video verification (answers the query itself)
+    if data.startswith("verify_"):
+        video_id = data.replace("verify_", "")
+        await handle_video_request(update, context, video_id, recheck_membership=True)
+        return
+    
+    await query.answer()
+    
     # Help button
     if data == "help":
         await query.message.reply_text(
-            get_message('help'),
+            await get_message('help'),
             parse_mode=ParseMode.MARKDOWN
         )
         return
     
-    # Video verification
-    if data.startswith("verify_"):
-        video_id = data.replace("verify_", "")
-        update.message = query.message
-        await handle_video_request(update, context, video_id)
-        return
-    
     # Admin only from here
     if user_id != ADMIN_ID:
         await query.answer("⛔ Admin only!", show_alert=True)
         return
     
+    await admin_callback(update, context)
+
+@in_lane(PRIORITY_ADMIN)
+async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle admin panel buttons"""
+    query = update.callback_query
+    data = query.data
+    user_id = query.from_user.id
+    
     # Admin panel navigation
     if data == "admin_main":
         stats = get_stats()
         text = f"""🔧 **CINEFLIX ADMIN PANEL**
 
 📊 **Statistics:**
-👥 Users: {stats['users']}
+👥 Users: {stats['users']} (today: {stats['active_today']} active, {stats['new_today']} new)
 📹 Videos: {stats['videos']}
 🔒 Force Join: {stats['force_join']}
 
@@ -587,7 +2989,7 @@ Select an option below:"""
     elif data == "admin_channels":
         await query.edit_message_text(
             "📺 **Channel Manager**\n\nManage force join channels:",
-            reply_markup=channel_manager_keyboard(),
+            reply_markup=await channel_manager_keyboard(),
             parse_mode=ParseMode.MARKDOWN
         )
     
@@ -599,24 +3001,84 @@ Select an option below:"""
         )
     
     elif data == "admin_settings":
+        delivery_mode = await get_setting('delivery_mode', DEFAULT_SETTINGS['delivery_mode'])
+        await query.edit_message_text(
+            "⚙️ **Settings**\n\n"
+            f"📦 Delivery Mode: `{delivery_mode}`\n\n"
+            "Configure bot settings:",
+            reply_markup=settings_keyboard(),
+            parse_mode=ParseMode.MARKDOWN
+        )
+    
+    elif data == "toggle_delivery_mode":
+        current = await get_setting('delivery_mode', DEFAULT_SETTINGS['delivery_mode'])
+        new_mode = 'copy' if current == 'file_id' else 'file_id'
+        await set_setting('delivery_mode', new_mode)
+        
+        await query.answer(f"Delivery Mode: {new_mode}")
         await query.edit_message_text(
-            "⚙️ **Settings**\n\nConfigure bot settings:",
+            "⚙️ **Settings**\n\n"
+            f"📦 Delivery Mode: `{new_mode}`\n\n"
+            "`copy` copies the channel post, `file_id` sends the stored file "
+            "(keeps working if the bot loses access to the channel).",
             reply_markup=settings_keyboard(),
             parse_mode=ParseMode.MARKDOWN
         )
     
     elif data == "admin_stats":
         stats = get_stats()
+        
+        days = []
+        for offset in range(STATS_DAYS_SHOWN):
+            day = day_key(datetime.utcnow() - timedelta(days=offset))
+            active, new = stats['daily'].get(day, (0, 0))
+            days.append(f"`{day}`  {active} / {new}")
+        days_text = "\n".join(days)
+        outbound_stats = outbound.metrics()
+        
+        hot = []
+        for position, (code, score) in enumerate(trending.top[:5], 1):
+            entry = search_index.videos.get(code, {})
+            title = (entry.get('caption') or entry.get('channel_name') or '').split('\n')[0][:30]
+            hot.append(f"{position}. `{code}` {escape_markdown(title)} ({score:g})")
+        trending_text = "\n".join(hot) or "No views yet"
+        
         text = f"""📊 **Detailed Statistics**
 
 👥 **Total Users:** {stats['users']}
 📹 **Total Videos:** {stats['videos']}
 🔒 **Force Join Channels:** {stats['force_join']}
 
+📅 **Daily Users (active / new):**
+{days_text}
+
+🔥 **Trending (views, {TRENDING_HALF_LIFE_HOURS:g}h half-life):**
+{trending_text}
+
+📤 **Outbound:** {outbound_stats['queued_total']} queued, {outbound_stats['in_flight']} in flight, {outbound_stats['flood_waits']} flood waits, {outbound_stats['dropped']} dropped
+
 🤖 **Bot Status:** ✅ Running
 💾 **Database:** ✅ Connected"""
         
-        await query.answer(text, show_alert=True)
+        await query.edit_message_text(
+            text,
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="admin_main")]]),
+            parse_mode=ParseMode.MARKDOWN
+        )
+    
+    elif data == "admin_metrics":
+        try:
+            await query.edit_message_text(
+                metrics_summary(),
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("🔄 Update", callback_data="admin_metrics")],
+                    [InlineKeyboardButton("🔙 Back", callback_data="admin_main")]
+                ]),
+                parse_mode=ParseMode.MARKDOWN
+            )
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
     
     elif data == "admin_refresh":
         await query.answer("🔄 Refreshed!")
@@ -626,8 +3088,46 @@ Select an option below:"""
         await query.message.delete()
         await query.answer("Panel closed")
     
+    elif data == "admin_broadcast":
+        await set_admin_state(user_id, {'action': 'broadcast'})
+        await query.message.reply_text(
+            "📣 **New Broadcast**\n\n"
+            "Send the message to broadcast (text, photo, video...).\n"
+            "It will be copied to every user.",
+            parse_mode=ParseMode.MARKDOWN
+        )
+    
+    elif data == "broadcast_start":
+        state = await pop_admin_state(user_id)
+        if not state or state['action'] != 'broadcast_confirm':
+            await query.edit_message_text("❌ Nothing to broadcast")
+            return
+        broadcast_id = await create_broadcast(state['from_chat_id'], state['message_id'])
+        if broadcast_id is None:
+            await query.edit_message_text("❌ Failed to start broadcast")
+            return
+        launch_broadcast(context.bot, broadcast_id)
+        await query.edit_message_text(
+            "🚀 Broadcast started! You will get a report when it is done.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(
+                "⏹ Stop Broadcast", callback_data=f"broadcast_stop_{broadcast_id}"
+            )]])
+        )
+    
+    elif data == "broadcast_cancel":
+        await pop_admin_state(user_id)
+        await query.edit_message_text("❌ Broadcast cancelled")
+    
+    elif data.startswith("broadcast_stop_"):
+        try:
+            broadcast_id = ObjectId(data.replace("broadcast_stop_", ""))
+        except InvalidId:
+            return
+        await set_broadcast_status(broadcast_id, 'cancelled')
+        await query.edit_message_text("⏹ Broadcast stopped")
+    
     elif data == "add_channel":
-        admin_states[user_id] = {'action': 'add_channel'}
+        await set_admin_state(user_id, {'action': 'add_channel'})
         await query.message.reply_text(
             "➕ **Add New Force Join Channel**\n\n"
             "Send channel details in this format:\n"
@@ -640,7 +3140,7 @@ Select an option below:"""
     
     elif data.startswith("remove_channel_"):
         channel_id = int(data.replace("remove_channel_", ""))
-        if remove_force_join_channel(channel_id):
+        if await remove_force_join_channel(channel_id):
             await query.answer("✅ Channel removed!")
             await button_callback(update, context)  # Refresh list
         else:
@@ -648,9 +3148,9 @@ Select an option below:"""
     
     elif data.startswith("edit_msg_"):
         msg_key = data.replace("edit_msg_", "")
-        admin_states[user_id] = {'action': 'edit_message', 'key': msg_key}
+        await set_admin_state(user_id, {'action': 'edit_message', 'key': msg_key})
         
-        current_msg = get_message(msg_key)
+        current_msg = await get_message(msg_key)
         await query.message.reply_text(
             f"✏️ **Editing {msg_key.replace('_', ' ').title()}**\n\n"
             f"Current message:\n\n{current_msg}\n\n"
@@ -660,9 +3160,9 @@ Select an option below:"""
     
     elif data.startswith("setting_"):
         setting_key = data.replace("setting_", "")
-        admin_states[user_id] = {'action': 'edit_setting', 'key': setting_key}
+        await set_admin_state(user_id, {'action': 'edit_setting', 'key': setting_key})
         
-        current = get_setting(setting_key)
+        current = await get_setting(setting_key)
         await query.message.reply_text(
             f"⚙️ **Editing {setting_key.replace('_', ' ').title()}**\n\n"
             f"Current value: `{current}`\n\n"
@@ -671,76 +3171,214 @@ Select an option below:"""
         )
     
     elif data == "setting_protection":
-        current = get_setting('video_protection', True)
+        current = await get_setting('video_protection', True)
         new_val = not current
-        set_setting('video_protection', new_val)
+        await set_setting('video_protection', new_val)
         
         status = "🔒 ON" if new_val else "🔓 OFF"
         await query.answer(f"Video Protection: {status}")
         await button_callback(update, context)
 
 # ===================== CHANNEL POST HANDLER =====================
+class ChannelPostBatcher:
+    """Collects channel uploads into batches.
+
+    Posts of one album (media_group_id), or posts in one channel with less
+    than `window` seconds between them, form a batch. A batch is saved with
+    one bulk write and reported to the admin in one digest message.
+    """
+
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        self.batches = {}
+        self.last_seen = {}
+
+    def add(self, bot, message):
+        """Queue a channel post; its batch is processed in the background"""
+        key = (message.chat.id, message.media_group_id)
+        batch = self.batches.setdefault(key, [])
+        batch.append({
+            'channel_id': message.chat.id,
+            'message_id': message.message_id,
+            'channel_name': message.chat.title or "Unknown",
+            **video_metadata(message)
+        })
+        self.last_seen[key] = time.monotonic()
+        
+        if len(batch) >= self.max_size:
+            self.batches.pop(key)
+            run_in_background(self.process(bot, batch))
+        elif len(batch) == 1:
+            run_in_background(self.close_when_quiet(bot, key, batch))
+
+    async def close_when_quiet(self, bot, key, batch):
+        """Wait until no post joined the batch for `window` seconds"""
+        while self.batches.get(key) is batch:
+            idle = time.monotonic() - self.last_seen[key]
+            if idle >= self.window:
+                self.batches.pop(key)
+                await self.process(bot, batch)
+                return
+            await asyncio.sleep(self.window - idle)
+
+    async def process(self, bot, batch):
+        """Save a batch and send the admin one digest"""
+        try:
+            result = await save_videos(batch)
+            if result is None:
+                await bot.send_message(
+                    chat_id=ADMIN_ID,
+                    text=f"❌ Failed to save {len(batch)} uploaded videos, check the logs."
+                )
+                return
+            
+            new_count, videos = result
+            for video in videos:
+                search_index.add(video)
+            if CATALOG_API:
+                await catalog.refresh(video['seq'] for video in videos)
+            
+            for text in video_digest(bot.username, videos, new_count):
+                await bot.send_message(chat_id=ADMIN_ID, text=text)
+            logger.info("📤 Sent upload digest for %s videos to admin", len(batch))
+        except Exception as e:
+            logger.error("❌ Error processing channel uploads: %s", e, exc_info=True)
+
+def video_metadata(message):
+    """File and caption details of a channel post, for file_id delivery and the catalog"""
+    if message.video:
+        media_type, media = 'video', message.video
+    elif message.animation:
+        media_type, media = 'animation', message.animation
+    else:
+        media_type, media = 'document', message.document
+    
+    thumbnail = getattr(media, 'thumbnail', None)
+    metadata = {
+        'media_type': media_type,
+        'file_id': media.file_id,
+        'file_unique_id': media.file_unique_id,
+        'duration': getattr(media, 'duration', None),
+        'width': getattr(media, 'width', None),
+        'height': getattr(media, 'height', None),
+        'file_size': media.file_size,
+        'mime_type': media.mime_type,
+        'file_name': media.file_name,
+        'caption': message.caption,
+        'thumb_file_id': thumbnail.file_id if thumbnail else None,
+    }
+    return {key: value for key, value in metadata.items() if value is not None}
+
+def video_digest(bot_username, videos, new_count):
+    """Admin digest for a batch of uploads, split to fit Telegram's message limit"""
+    channel_name = videos[0]['channel_name']
+    header = f"""🎬 {len(videos)} Video(s) Uploaded! ({new_count} new)
+
+📺 Channel: {channel_name}
+"""
+    lines = [
+        f"📋 {video['message_id']}: https://t.me/{bot_username}?start={video['code']}"
+        for video in videos
+    ]
+    footer = "\n✅ Saved to database! Users can now watch these videos!"
+    
+    texts = []
+    current = header
+    for line in lines:
+        if len(current) + len(line) + len(footer) > 4000:
+            texts.append(current)
+            current = ""
+        current += "\n" + line
+    texts.append(current + "\n" + footer)
+    return texts
+
+channel_post_batcher = ChannelPostBatcher(INGEST_WINDOW, INGEST_BATCH_MAX)
+
+@instrumented('channel_post')
+@in_lane(PRIORITY_ADMIN)
 async def channel_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle videos posted in channels"""
     try:
-        logger.info(f"📥 Channel post received! Update: {update}")
-        
         message = update.channel_post
+        if LOG_UPDATES:
+            logger.info("📨 Channel post: %s", update)
         
         if not message:
             logger.warning("⚠️ No message in channel_post update")
             return
         
-        logger.info(f"📝 Message type - Video: {bool(message.video)}, Document: {bool(message.document)}, Animation: {bool(message.animation)}")
-        
         if not (message.video or message.document or message.animation):
-            logger.info("⏭️ Not a video/document/animation, skipping")
+            logger.debug("⏭️ Not a video/document/animation, skipping")
+            set_outcome('skipped')
             return
         
-        channel_id = message.chat.id
-        message_id = message.message_id
-        channel_name = message.chat.title or "Unknown"
+        logger.debug("📹 Queued video - Channel: %s (%s), Message ID: %s", message.chat.title, message.chat.id, message.message_id)
+        channel_post_batcher.add(context.bot, message)
         
-        logger.info(f"📹 Processing video - Channel: {channel_name} ({channel_id}), Message ID: {message_id}")
-        
-        # Save to database
-        save_video(channel_id, message_id, channel_name)
-        logger.info(f"💾 Video saved to database")
-        
-        # Get bot username for deep link
-        bot_info = await context.bot.get_me()
-        bot_username = bot_info.username
-        
-        # Create admin notification with simple text (no markdown issues)
-        deep_link = f"https://t.me/{bot_username}?start={message_id}"
-        
-        info_text = f"""🎬 New Video Uploaded!
-
-📺 Channel: {channel_name}
-📋 Message ID: {message_id}
-
-🔗 Shortcode for Mini App:
-{message_id}
+    except Exception as e:
+        set_outcome('error')
+        logger.error("❌ Error in channel_post handler: %s", e, exc_info=True)
 
-🌐 Direct Link:
-{deep_link}
+# ===================== ADMIN METRICS VIEW =====================
+def format_latency(seconds):
+    if seconds is None:
+        return f">{LATENCY_BUCKETS[-1]:g}s"
+    return f"{seconds * 1000:g}ms" if seconds < 1 else f"{seconds:g}s"
 
-✅ Video saved to database!
-Users can now watch this video!"""
-        
-        logger.info(f"📤 Sending notification to admin {ADMIN_ID}")
-        
-        await context.bot.send_message(
-            chat_id=ADMIN_ID,
-            text=info_text
+def metrics_summary():
+    """Compact view of the metrics for the admin panel"""
+    lines = ["📈 **Metrics** (since start, p50 / p95)", "", "⏱ **Handlers:**"]
+    for (handler, outcome), (counts, _) in sorted(handler_seconds.series.items()):
+        lines.append(
+            f"`{handler}/{outcome}`: {sum(counts)} · "
+            f"{format_latency(handler_seconds.quantile(0.5, counts))} / "
+            f"{format_latency(handler_seconds.quantile(0.95, counts))}"
         )
-        
-        logger.info(f"✅ Successfully notified admin about video {message_id}")
-        
-    except Exception as e:
-        logger.error(f"❌ Error in channel_post handler: {e}", exc_info=True)
+    
+    db_counts = db_seconds.merged()
+    slowest = sorted(
+        db_seconds.series,
+        key=lambda labels: db_seconds.quantile(0.95, db_seconds.series[labels][0]) or float('inf'),
+        reverse=True
+    )[:3]
+    lines += [
+        "",
+        f"💾 **DB:** {sum(db_counts)} calls · "
+        f"{format_latency(db_seconds.quantile(0.5, db_counts))} / "
+        f"{format_latency(db_seconds.quantile(0.95, db_counts))}",
+    ]
+    for (helper,) in slowest:
+        counts = db_seconds.series[(helper,)][0]
+        lines.append(f"  `{helper}`: p95 {format_latency(db_seconds.quantile(0.95, counts))}")
+    
+    api_counts = api_seconds.merged()
+    api_errors = sum(sum(api_seconds.merged(lambda labels: labels[1] == outcome))
+                     for outcome in ('bad_request', 'forbidden', 'network_error', 'error'))
+    flood_waits = sum(api_seconds.merged(lambda labels: labels[1] == 'flood_wait'))
+    queue_counts = api_queue_seconds.merged()
+    lines += [
+        "",
+        f"📤 **Bot API:** {sum(api_counts)} calls · "
+        f"{format_latency(api_seconds.quantile(0.5, api_counts))} / "
+        f"{format_latency(api_seconds.quantile(0.95, api_counts))}",
+        f"  queue p95 {format_latency(api_seconds.quantile(0.95, queue_counts))} · "
+        f"{api_errors} errors · {flood_waits} flood waits",
+        "",
+        "🎯 **Cache hit ratio:**",
+    ]
+    for cache in ('video', 'membership'):
+        hits = cache_requests.values.get((cache, 'hit'), 0)
+        misses = cache_requests.values.get((cache, 'miss'), 0)
+        ratio = f"{hits * 100 / (hits + misses):.0f}%" if hits + misses else "-"
+        lines.append(f"  {cache}: {ratio} of {hits + misses}")
+    sources = {source: membership_checks.values.get((source,), 0) for source in ('cache', 'index', 'live')}
+    lines.append(f"  membership answers: {sources['cache']} cache / {sources['index']} index / {sources['live']} live")
+    return "\n".join(lines)
 
 # ===================== ADMIN MESSAGE HANDLER =====================
+@instrumented('admin_message')
+@in_lane(PRIORITY_ADMIN)
 async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle admin text messages for editing"""
     user_id = update.effective_user.id
@@ -748,17 +3386,37 @@ async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
     if user_id != ADMIN_ID:
         return
     
-    if user_id not in admin_states:
+    state = await get_admin_state(user_id)
+    if not state:
         return
     
     text = update.message.text
-    state = admin_states[user_id]
     
     if text == "/cancel":
-        del admin_states[user_id]
+        await pop_admin_state(user_id)
         await update.message.reply_text("❌ Cancelled")
         return
     
+    if state['action'] == 'broadcast':
+        await set_admin_state(user_id, {
+            'action': 'broadcast_confirm',
+            'from_chat_id': update.effective_chat.id,
+            'message_id': update.message.message_id
+        })
+        stats = get_stats()
+        await update.message.reply_text(
+            f"📣 Send this message to {stats['users']} users?",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("✅ Send", callback_data="broadcast_start"),
+                InlineKeyboardButton("❌ Cancel", callback_data="broadcast_cancel")
+            ]])
+        )
+        return
+    
+    if text is None:
+        await update.message.reply_text("❌ Please send text")
+        return
+    
     if state['action'] == 'add_channel':
         parts = text.split()
         if len(parts) != 2:
@@ -772,9 +3430,15 @@ async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
             channel_id = int(parts[0])
             username = parts[1].replace('@', '')
             
-            if add_force_join_channel(channel_id, username):
+            if await add_force_join_channel(channel_id, username):
                 await update.message.reply_text(f"✅ Channel @{username} added!")
-                del admin_states[user_id]
+                await pop_admin_state(user_id)
+                if not await bot_is_channel_admin(context.bot, channel_id):
+                    await update.message.reply_text(
+                        "⚠️ Bot is not admin in this channel.\n"
+                        "Make it admin so joins/leaves are tracked automatically. "
+                        "Until then every user is checked live."
+                    )
             else:
                 await update.message.reply_text("❌ Failed to add channel")
         except ValueError:
@@ -782,9 +3446,9 @@ async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
     
     elif state['action'] == 'edit_message':
         msg_key = state['key']
-        if set_message(msg_key, text):
+        if await set_message(msg_key, text):
             await update.message.reply_text("✅ Message updated!")
-            del admin_states[user_id]
+            await pop_admin_state(user_id)
         else:
             await update.message.reply_text("❌ Failed to update message")
     
@@ -801,13 +3465,14 @@ async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
         elif setting_key in ['video_protection']:
             text = text.lower() in ['true', 'yes', '1', 'on']
         
-        if set_setting(setting_key, text):
+        if await set_setting(setting_key, text):
             await update.message.reply_text(f"✅ {setting_key} updated!")
-            del admin_states[user_id]
+            await pop_admin_state(user_id)
         else:
             await update.message.reply_text("❌ Failed to update setting")
 
 # ===================== ADMIN COMMANDS =====================
+@in_lane(PRIORITY_ADMIN)
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show admin panel"""
     if update.effective_user.id != ADMIN_ID:
@@ -817,7 +3482,7 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = f"""🔧 **CINEFLIX ADMIN PANEL**
 
 📊 **Statistics:**
-👥 Users: {stats['users']}
+👥 Users: {stats['users']} (today: {stats['active_today']} active, {stats['new_today']} new)
 📹 Videos: {stats['videos']}
 🔒 Force Join: {stats['force_join']}
 
@@ -832,32 +3497,753 @@ Select an option below:"""
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show help"""
     await update.message.reply_text(
-        get_message('help'),
+        await get_message('help'),
         parse_mode=ParseMode.MARKDOWN
     )
 
 # ===================== ERROR HANDLER =====================
+def describe_update(update):
+    """Short description of an update for logs, e.g. 'update 12 (callback_query from 42)'"""
+    if not isinstance(update, Update):
+        return repr(update)
+    kind = next((name for name in Update.ALL_TYPES if getattr(update, name, None)), 'unknown')
+    user, chat = update.effective_user, update.effective_chat
+    source = user.id if user else chat.id if chat else '?'
+    return f"update {update.update_id} ({kind} from {source})"
+
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Log errors"""
-    logger.error(f"Update {update} caused error {context.error}")
+    """Log errors (with the whole update when LOG_UPDATES=1)"""
+    logger.error(
+        "%s caused error %s",
+        update if LOG_UPDATES else describe_update(update), context.error,
+        exc_info=context.error
+    )
 
-# ===================== MAIN FUNCTION =====================
-def main():
-    """Start the bot"""
-    logger.info("🚀 Starting CINEFLIX Ultimate Bot...")
+# ===================== REPLICA COORDINATION =====================
+# With MULTI_REPLICA several copies of the bot share one MongoDB:
+# - one replica holds the 'leader' lease and runs the singleton jobs
+#   (broadcasts, membership heartbeat)
+# - writes that change cached data publish an event in events_col; every
+#   replica polls it and updates its own caches
+# Without MULTI_REPLICA this process is always the leader and no events
+# are written.
+
+@run_in_db_executor
+def acquire_lease(name, seconds):
+    """Take or renew a lease for this replica; True if we hold it"""
+    now = datetime.utcnow()
+    try:
+        leases_col.update_one(
+            {'_id': name, '$or': [{'holder': INSTANCE_ID}, {'expires_at': {'$lte': now}}]},
+            {'$set': {'holder': INSTANCE_ID, 'expires_at': now + timedelta(seconds=seconds)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False  # held by another replica
+    except Exception as e:
+        logger.error("Error acquiring lease %s: %s", name, e)
+        return False
+
+@run_in_db_executor
+def release_lease(name):
+    """Give up a lease so another replica can take it right away"""
+    try:
+        leases_col.delete_one({'_id': name, 'holder': INSTANCE_ID})
+    except Exception as e:
+        logger.error("Error releasing lease %s: %s", name, e)
+
+class LeaderLease:
+    """The lease that decides which replica runs the singleton jobs"""
+
+    def __init__(self, name, seconds):
+        self.name = name
+        self.seconds = seconds
+        self.is_leader = not MULTI_REPLICA
+
+    async def run(self, bot):
+        """Background job: hold (or wait for) the lease, renewing it every third of its length"""
+        while True:
+            held = await acquire_lease(self.name, self.seconds)
+            if held != self.is_leader:
+                self.is_leader = held
+                logger.info("👑 %s %s the leader", INSTANCE_ID, 'is now' if held else 'is no longer')
+                if not held:
+                    stop_local_broadcasts()
+            if held:
+                # Also picks up broadcasts started on other replicas
+                await resume_broadcasts(bot)
+            await asyncio.sleep(self.seconds / 3)
+
+    async def release(self):
+        if MULTI_REPLICA and self.is_leader:
+            self.is_leader = False
+            await release_lease(self.name)
+
+leader = LeaderLease('leader', LEADER_LEASE_SECONDS)
+
+@run_in_db_executor
+def publish_event(kind, data=None):
+    """Tell the other replicas that cached data changed"""
+    if not MULTI_REPLICA:
+        return
+    try:
+        events_col.insert_one({
+            'kind': kind,
+            'data': data,
+            'origin': INSTANCE_ID,
+            'created_at': datetime.utcnow()
+        })
+    except Exception as e:
+        logger.error("Error publishing %s event: %s", kind, e)
+
+@run_in_db_executor
+def fetch_events(since):
+    """Events from other replicas created after `since` (oldest first)"""
+    try:
+        return list(events_col.find({
+            '_id': {'$gte': ObjectId.from_datetime(since)},
+            'origin': {'$ne': INSTANCE_ID}
+        }).sort('_id', ASCENDING))
+    except Exception as e:
+        logger.error("Error reading events: %s", e)
+        return None
+
+@run_in_db_executor
+def fetch_videos_by_code(codes):
+    """Get the videos with these short codes"""
+    try:
+        return list(videos_col.find({'code': {'$in': codes}}))
+    except Exception as e:
+        logger.error("Error getting videos: %s", e)
+        return []
+
+async def apply_event(event):
+    """Update this replica's caches for a change made by another replica"""
+    kind, data = event['kind'], event.get('data')
+    if kind == 'config':
+        await load_config_cache()
+    elif kind == 'videos':
+        videos = await fetch_videos_by_code(data)
+        for video in videos:
+            video_cache.pop(video['code'])
+            video_cache.pop(str(video['message_id']))
+            search_index.add(video)
+        if CATALOG_API:
+            await catalog.refresh(video['seq'] for video in videos)
+    elif kind == 'membership':
+        channel_id, user_id, joined = data
+        cache_membership(channel_id, user_id, joined)
+    elif kind == 'recommendations':
+        await load_recommendations(data)
+
+async def poll_events_periodically():
+    """Background job: apply events published by other replicas"""
+    applied = TTLCache(100000)
+    last_poll = datetime.utcnow()
+    while True:
+        await asyncio.sleep(EVENT_POLL_INTERVAL)
+        # Look back a little: replicas' clocks differ and inserts can land out of _id order
+        now = datetime.utcnow()
+        events = await fetch_events(last_poll - timedelta(seconds=EVENT_LOOKBACK_SECONDS))
+        if events is None:
+            continue
+        last_poll = now
+        for event in events:
+            if applied.get(event['_id']):
+                continue
+            applied.set(event['_id'], True, EVENT_LOOKBACK_SECONDS * 2)
+            try:
+                await apply_event(event)
+            except Exception as e:
+                logger.error("Error applying %s event: %s", event['kind'], e, exc_info=True)
+
+# ===================== BACKGROUND SERVICES =====================
+background_tasks = []
+pending_writes = set()
+
+def detached_context():
+    """Context for a task that outlives the update that started it, so its
+    calls are not counted in that update's round trips"""
+    context = contextvars.copy_context()
+    context.run(update_round_trips.set, None)
+    context.run(update_slot.set, None)
+    return context
+
+def start_background_task(coro):
+    """Run a long-lived coroutine until the bot stops"""
+    task = asyncio.create_task(coro, context=detached_context())
+    background_tasks.append(task)
+    return task
+
+def run_in_background(coro):
+    """Run a short DB write or reply without making the caller wait for it"""
+    task = asyncio.create_task(coro, context=detached_context())
+    pending_writes.add(task)
+    task.add_done_callback(pending_writes.discard)
+    return task
+
+async def start_services(application: Application):
+    """post_init hook: warm caches and start background jobs"""
+    await reconcile_membership_index()
+    await load_config_cache()
+    await reconcile_stats()
+    if not MULTI_REPLICA:
+        await resume_broadcasts(application.bot)
+    await load_search_index()
+    await load_trending()
+    await load_recommendations()
+    if CATALOG_API:
+        catalog.bot_username = application.bot.username
+        await catalog.load()
+    trending.refresh()
+    if (CATALOG_API or METRICS_API) and not WEBHOOK_URL:
+        # Webhook mode starts the HTTP server itself
+        await http_server.start('0.0.0.0', PORT)
+        logger.info("🌐 HTTP API on port %s", PORT)
+    start_background_task(refresh_config_cache_periodically())
+    start_background_task(reconcile_stats_periodically())
+    start_background_task(membership_heartbeat_periodically())
+    start_background_task(rebuild_recommendations_periodically())
+    for buffer in write_behind_buffers:
+        start_background_task(buffer.run())
+    if MULTI_REPLICA:
+        start_background_task(leader.run(application.bot))
+        start_background_task(poll_events_periodically())
+        logger.info("🧩 Multi-replica mode as %s", INSTANCE_ID)
+
+async def stop_services(application: Application):
+    """post_stop hook: stop background jobs"""
+    await http_server.stop()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await asyncio.gather(*pending_writes, return_exceptions=True)
+    # Write out whatever is still buffered so a restart loses nothing
+    for buffer in write_behind_buffers:
+        await buffer.flush()
+    await leader.release()
+
+# ===================== UPDATE PROCESSING =====================
+# Only the update types the handlers below use
+ALLOWED_UPDATES = [
+    Update.MESSAGE,
+    Update.CALLBACK_QUERY,
+    Update.CHANNEL_POST,
+    Update.CHAT_MEMBER,
+    Update.INLINE_QUERY,
+]
+
+async def process_counted(coroutine):
+    """Await an update's processing in its own round-trip scope, so calls
+    made outside the handlers are counted too"""
+    trips = RoundTrips()
+    token = update_round_trips.set(trips)
+    try:
+        await coroutine
+    finally:
+        update_round_trips.reset(token)
+        record_round_trips('update', 'ok', trips)
+
+def update_order_key(update):
+    """Updates with the same key are processed one after another"""
+    if not isinstance(update, Update) or is_video_request(update):
+        return None
+    if update.effective_user:
+        return ('user', update.effective_user.id)
+    if update.effective_chat:
+        return ('chat', update.effective_chat.id)
+    return None
+
+class UpdateSlots:
+    """CONCURRENT_UPDATES slots. Updates coming back from a wait on the
+    outbound scheduler get a free slot before updates that have not started"""
+
+    def __init__(self, limit):
+        self.free = limit
+        self.returning = deque()
+        self.starting = deque()
+
+    async def acquire(self, returning=False):
+        if self.free > 0 and not self.returning and (returning or not self.starting):
+            self.free -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        (self.returning if returning else self.starting).append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if not waiter.cancelled():
+                self.release()  # handed over just before the cancel
+            raise
+
+    def release(self):
+        for waiters in (self.returning, self.starting):
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self.free += 1
+
+class UpdateSlot:
+    """The slot one update holds.
+
+    The update's Bot API calls give it back while they wait for their turn
+    in the outbound scheduler, so updates queued behind a busy chat or a
+    low-priority lane don't keep other updates from starting. Calls made
+    at the same time (gather) share it: it is given back by the first one
+    to wait and taken again when the last one has its turn.
+    """
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.held = False
+        self.waiting = 0
+
+    async def __aenter__(self):
+        await self.slots.acquire()
+        self.held = True
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.held:
+            self.held = False
+            self.slots.release()
+
+    async def released_while(self, awaitable):
+        """Await without holding the slot"""
+        self.waiting += 1
+        if self.held:
+            self.held = False
+            self.slots.release()
+        try:
+            return await awaitable
+        finally:
+            self.waiting -= 1
+            if self.waiting == 0 and not self.held:
+                await self.slots.acquire(returning=True)
+                if self.held or self.waiting:
+                    # Another call took it back first, or is waiting again
+                    self.slots.release()
+                else:
+                    self.held = True
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently but keeps each user's updates in order.
+
+    Admin edit flows keep state between messages, so two updates from the
+    same user must never run at the same time.
+
+    PTB takes its own semaphore before do_process_update, so an update
+    waiting for its user's turn would hold a slot. That limit is set out of
+    the way here and the real one is taken only once it is the update's
+    turn, so one busy user cannot hold up everyone else. The slot is also
+    given back while the update's Bot API calls wait on the outbound
+    scheduler (see UpdateSlot).
+    """
+
+    UNLIMITED = 2 ** 31
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(self.UNLIMITED)
+        self._slots = UpdateSlots(max_concurrent_updates)
+        # key -> [lock, number of updates holding or waiting for it]
+        self._locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        key = update_order_key(update)
+        if key is None:
+            await self._process(coroutine)
+            return
+        
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._process(coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def _process(self, coroutine):
+        async with UpdateSlot(self._slots) as slot:
+            token = update_slot.set(slot)
+            try:
+                await process_counted(coroutine)
+            finally:
+                update_slot.reset(token)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# ===================== HTTP SERVER =====================
+class HttpRequest:
+    """A parsed HTTP request"""
+
+    def __init__(self, method, target, headers, body):
+        parts = urlsplit(target)
+        self.method = method
+        self.path = parts.path
+        self.query = dict(parse_qsl(parts.query))
+        self.headers = headers
+        self.body = body
+
+class HttpServer:
+    """Minimal asyncio HTTP/1.1 server for the webhook and small JSON endpoints.
+
+    Handlers are ``async def handler(request) -> (status, headers, body)``.
+    """
+
+    MAX_BODY = 1024 * 1024
+    IDLE_TIMEOUT = 30
+    REASONS = {
+        200: 'OK', 204: 'No Content', 304: 'Not Modified', 400: 'Bad Request', 403: 'Forbidden',
+        404: 'Not Found', 413: 'Payload Too Large', 500: 'Internal Server Error'
+    }
+
+    def __init__(self):
+        self.routes = {}
+        self._server = None
+
+    def route(self, method, path, handler):
+        self.routes[(method, path)] = handler
+
+    async def start(self, host, port):
+        self._server = await asyncio.start_server(self._serve_connection, host, port)
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _read_request(self, reader):
+        line = await asyncio.wait_for(reader.readline(), self.IDLE_TIMEOUT)
+        if not line:
+            return None
+        method, target, _ = line.decode('latin-1').split(' ', 2)
+        
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        
+        length = int(headers.get('content-length', 0))
+        if length > self.MAX_BODY:
+            raise ValueError("body too large")
+        body = await reader.readexactly(length) if length else b''
+        return HttpRequest(method, target, headers, body)
+
+    async def _serve_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except (ValueError, asyncio.IncompleteReadError):
+                    await self._write(writer, 400, {}, b'')
+                    break
+                if request is None:
+                    break
+                
+                handler = self.routes.get((request.method, request.path))
+                if handler is None:
+                    status, headers, body = 404, {}, b''
+                else:
+                    try:
+                        status, headers, body = await handler(request)
+                    except Exception as e:
+                        logger.error("Error in HTTP handler %s: %s", request.path, e, exc_info=True)
+                        status, headers, body = 500, {}, b''
+                
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+                await self._write(writer, status, headers, body, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _write(self, writer, status, headers, body, keep_alive=False):
+        head = [f"HTTP/1.1 {status} {self.REASONS.get(status, 'OK')}"]
+        headers = dict(headers)
+        headers['Content-Length'] = str(len(body))
+        headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+        head += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + body)
+        await writer.drain()
+
+def json_response(data, status=200):
+    return status, {'Content-Type': 'application/json'}, json.dumps(data).encode()
+
+http_server = HttpServer()
+
+async def health_endpoint(request):
+    return 200, {'Content-Type': 'text/plain'}, b'OK'
+
+http_server.route('GET', '/', health_endpoint)
+
+async def metrics_endpoint(request):
+    return 200, {'Content-Type': 'text/plain; version=0.0.4'}, render_metrics().encode()
+
+if METRICS_API:
+    http_server.route('GET', '/metrics', metrics_endpoint)
+
+# ===================== MINI APP CATALOG API =====================
+# The catalog is split into pages by sequence number (page n holds the
+# videos with seq // CATALOG_PAGE_SIZE == n), so a new upload only changes
+# the newest page. Every page is kept pre-rendered and pre-compressed
+# with its ETag; requests never touch MongoDB.
+class CatalogPage:
+    """One pre-rendered catalog page: JSON body per content encoding and its ETag"""
+
+    def __init__(self, data):
+        body = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode()
+        self.etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+        self.bodies = {'identity': body, 'gzip': gzip.compress(body, 6)}
+        if brotli:
+            self.bodies['br'] = brotli.compress(body)
+
+def catalog_item(video, bot_username):
+    """Public fields of a video for the Mini App"""
+    item = {
+        'code': video['code'],
+        'link': f"https://t.me/{bot_username}?start={video['code']}",
+        'channel': video.get('channel_name'),
+        'saved_at': video['saved_at'].isoformat() + 'Z' if video.get('saved_at') else None,
+    }
+    for field in ('media_type', 'caption', 'duration', 'width', 'height', 'file_size', 'mime_type'):
+        if video.get(field) is not None:
+            item[field] = video[field]
+    return item
+
+@run_in_db_executor
+def build_catalog_pages(buckets, bot_username, known=()):
+    """Render catalog pages; `buckets` is a set of page numbers or None for all.
+
+    `known` are the page numbers already built. Sequence numbers have gaps
+    (re-posts, failed writes), so a page links to the next older page that
+    exists rather than to n - 1.
+    """
+    query = {'seq': {'$exists': True}}
+    if buckets is not None:
+        query = {'$or': [
+            {'seq': {'$gte': n * CATALOG_PAGE_SIZE, '$lt': (n + 1) * CATALOG_PAGE_SIZE}}
+            for n in buckets
+        ]}
+    
+    grouped = {n: [] for n in buckets or ()}
+    for video in videos_col.find(query).sort('seq', -1):
+        grouped.setdefault(video['seq'] // CATALOG_PAGE_SIZE, []).append(
+            catalog_item(video, bot_username)
+        )
+    
+    grouped = {n: items for n, items in grouped.items() if items}
+    
+    numbers = sorted(set(known) | set(grouped))
+    pages = {}
+    for n, items in grouped.items():
+        i = bisect.bisect_left(numbers, n)
+        pages[n] = CatalogPage({
+            'cursor': n,
+            'next_cursor': numbers[i - 1] if i else None,
+            'videos': items
+        })
+    return pages
+
+class Catalog:
+    """Pre-rendered catalog pages, newest first"""
+
+    def __init__(self):
+        self.pages = {}
+        self.bot_username = ''
+        self.empty = CatalogPage({'cursor': None, 'next_cursor': None, 'videos': []})
+        self._lock = asyncio.Lock()
+
+    async def load(self):
+        async with self._lock:
+            try:
+                self.pages = await build_catalog_pages(None, self.bot_username)
+                logger.info("📚 Catalog loaded: %s pages", len(self.pages))
+            except Exception as e:
+                logger.error("Error loading catalog: %s", e)
+
+    async def refresh(self, seqs):
+        """Re-render only the pages holding these sequence numbers"""
+        buckets = {seq // CATALOG_PAGE_SIZE for seq in seqs}
+        if not buckets:
+            return
+        async with self._lock:
+            try:
+                self.pages.update(await build_catalog_pages(buckets, self.bot_username, list(self.pages)))
+            except Exception as e:
+                logger.error("Error refreshing catalog pages %s: %s", sorted(buckets), e)
+
+    def page(self, cursor=None):
+        if cursor is None:
+            return self.pages[max(self.pages)] if self.pages else self.empty
+        return self.pages.get(cursor)
+
+catalog = Catalog()
+
+CATALOG_CORS_HEADERS = {
+    'Access-Control-Allow-Origin': CATALOG_CORS_ORIGIN,
+    'Access-Control-Allow-Methods': 'GET, OPTIONS',
+    'Access-Control-Allow-Headers': 'If-None-Match',
+    'Access-Control-Expose-Headers': 'ETag',
+    'Access-Control-Max-Age': '86400',
+}
+
+def pick_encoding(accept_encoding):
+    """Best encoding we have for an Accept-Encoding header"""
+    accepted = {part.split(';')[0].strip() for part in accept_encoding.lower().split(',')}
+    for encoding in ('br', 'gzip'):
+        if encoding in accepted and (encoding != 'br' or brotli):
+            return encoding
+    return 'identity'
+
+async def catalog_endpoint(request):
+    """GET /api/catalog[?cursor=N]: a page of videos, newest first"""
+    cursor = request.query.get('cursor')
+    if cursor is not None:
+        try:
+            cursor = int(cursor)
+        except ValueError:
+            status, headers, body = json_response({'error': 'bad cursor'}, 400)
+            return status, {**headers, **CATALOG_CORS_HEADERS}, body
+    
+    page = catalog.page(cursor)
+    if page is None:
+        status, headers, body = json_response({'error': 'unknown cursor'}, 404)
+        return status, {**headers, **CATALOG_CORS_HEADERS}, body
+    return serve_page(request, page)
+
+def serve_page(request, page):
+    """Answer with a pre-rendered page: 304 if the client has it, else the best encoding"""
+    headers = {
+        **CATALOG_CORS_HEADERS,
+        'ETag': page.etag,
+        'Cache-Control': f'public, max-age={CATALOG_MAX_AGE}',
+        'Vary': 'Accept-Encoding',
+    }
+    if_none_match = request.headers.get('if-none-match', '')
+    if if_none_match:
+        tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+        if page.etag in tags or '*' in tags:
+            return 304, headers, b''
+    
+    encoding = pick_encoding(request.headers.get('accept-encoding', ''))
+    headers['Content-Type'] = 'application/json; charset=utf-8'
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return 200, headers, page.bodies[encoding]
+
+def trending_page(top):
+    """Render the trending list for the catalog API"""
+    items = []
+    for code, score in top:
+        entry = search_index.videos.get(code)
+        if entry is None:
+            continue
+        items.append({
+            'code': code,
+            'link': f"https://t.me/{catalog.bot_username}?start={code}",
+            'channel': entry['channel_name'],
+            'caption': entry['caption'],
+            'score': score,
+            'views': search_index.views.get(code, 0),
+        })
+    return CatalogPage({'videos': items})
+
+async def trending_endpoint(request):
+    """GET /api/trending: the current trending list"""
+    return serve_page(request, trending.page or catalog.empty)
+
+async def catalog_preflight(request):
+    return 204, CATALOG_CORS_HEADERS, b''
+
+if CATALOG_API:
+    http_server.route('GET', '/api/catalog', catalog_endpoint)
+    http_server.route('OPTIONS', '/api/catalog', catalog_preflight)
+    http_server.route('GET', '/api/trending', trending_endpoint)
+    http_server.route('OPTIONS', '/api/trending', catalog_preflight)
+
+# ===================== WEBHOOK MODE =====================
+async def run_webhook(application: Application):
+    """Serve updates from a Telegram webhook until SIGINT/SIGTERM"""
+    async def webhook_endpoint(request):
+        token = request.headers.get('x-telegram-bot-api-secret-token', '')
+        if not hmac.compare_digest(token, WEBHOOK_SECRET):
+            return 403, {}, b''
+        try:
+            update = Update.de_json(json.loads(request.body), application.bot)
+        except ValueError:
+            return 400, {}, b''
+        await application.update_queue.put(update)
+        return 200, {}, b''
+    
+    http_server.route('POST', WEBHOOK_PATH, webhook_endpoint)
     
-    # Initialize defaults
-    initialize_defaults()
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
     
-    # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    async with application:
+        await start_services(application)
+        await application.start()
+        await http_server.start('0.0.0.0', PORT)
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+            max_connections=min(max(CONCURRENT_UPDATES, 1), 100)
+        )
+        logger.info("🌐 Webhook mode on port %s", PORT)
+        
+        await stop_event.wait()
+        
+        await http_server.stop()
+        await application.stop()
+        await stop_services(application)
+
+# ===================== MAIN FUNCTION =====================
+def build_application(builder=None):
+    """Create the Application with all handlers.
+
+    A pre-configured ApplicationBuilder can be passed in (e.g. with a
+    different base_url for testing).
+    """
+    builder = builder or Application.builder()
+    application = (
+        builder
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .rate_limiter(outbound)
+        .post_init(start_services)
+        .post_stop(stop_services)
+        .build()
+    )
     
     # Add handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("admin", admin_command))
     application.add_handler(CallbackQueryHandler(button_callback))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, admin_message_handler))
+    application.add_handler(InlineQueryHandler(inline_query))
+    application.add_handler(ChatMemberHandler(track_channel_membership, ChatMemberHandler.CHAT_MEMBER))
+    application.add_handler(MessageHandler(filters.ChatType.PRIVATE & ~filters.COMMAND, admin_message_handler))
     
     # Channel post handler - catches ALL channel posts first
     application.add_handler(MessageHandler(
@@ -868,12 +4254,32 @@ def main():
     # Error handler
     application.add_error_handler(error_handler)
     
+    return application
+
+def main():
+    """Start the bot"""
+    logger.info("🚀 Starting CINEFLIX Ultimate Bot...")
+    
+    # Create indexes and initialize defaults (runs before the event loop starts)
+    ensure_indexes()
+    # Replicas starting together must not hand out codes twice
+    if not MULTI_REPLICA or acquire_lease.sync('backfill_video_codes', 300):
+        backfill_video_codes()
+    if CHECK_QUERY_PLANS:
+        check_query_plans()
+    initialize_defaults.sync()
+    
+    application = build_application()
+    
     logger.info("✅ CINEFLIX Ultimate Bot is running!")
-    logger.info(f"👑 Admin: {ADMIN_ID}")
-    logger.info(f"💾 MongoDB: Connected")
-    logger.info(f"🎬 Ready to serve!")
+    logger.info("👑 Admin: %s", ADMIN_ID)
+    logger.info("💾 MongoDB: Connected")
+    logger.info("🎬 Ready to serve!")
     
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,520 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+🧪 CINEFLIX LOAD TEST
+Runs the bot's Application against a local fake Bot API server and
+replays scripted traffic. Nothing is sent to Telegram.
+
+    python loadtest.py --scenario mixed --count 5000 --rate 300
+    python loadtest.py --scenario deep_links --mongo-uri mongodb://localhost:27017
+    python loadtest.py --scenario user_flood --count 300 --rate 20 --api-latency 200 --budget
+
+Without --mongo-uri an in-memory MongoDB (mongomock) is used:
+    pip install mongomock
+"""
+
+import os
+import sys
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from urllib.parse import parse_qsl, urlsplit
+
+# The bot reads its configuration when it is imported
+os.environ.setdefault("BOT_TOKEN", "123456:LOADTEST")
+os.environ.setdefault("ADMIN_ID", "1")
+
+ADMIN_ID = int(os.environ["ADMIN_ID"])
+FORCE_JOIN_CHANNELS = [(-1001000000001, 'loadtest_one'), (-1001000000002, 'loadtest_two')]
+UPLOAD_CHANNEL_ID = -1001000000100
+FIRST_USER_ID = 100000
+CAPTION_WORDS = [
+    'movie', 'drama', 'action', 'comedy', 'thriller', 'episode', 'season', 'part', 'full', 'hd',
+    'নাটক', 'মুভি', 'গান', 'ভালোবাসা', 'হাসি', 'নতুন', 'পর্ব', 'সিরিজ',
+]
+
+# Traffic mixes: action -> weight
+SCENARIOS = {
+    'deep_links': {'deep_link': 1},
+    'verify_spam': {'verify': 1},
+    'uploads': {'upload': 1},
+    'admin': {'admin_panel': 1},
+    'search': {'inline_search': 1},
+    'mixed': {'deep_link': 70, 'verify': 12, 'inline_search': 10, 'upload': 5, 'admin_panel': 3},
+    # One user sends most of the traffic; everyone else must not wait for them
+    'user_flood': {'flood_search': 4, 'inline_search': 1},
+}
+
+# user_flood: p95 end-to-end ms allowed for the other users' updates with --budget
+FLOOD_BYSTANDER_P95_MS = 500
+FLOOD_USER_ID = FIRST_USER_ID - 1
+
+ADMIN_CALLBACKS = ['admin_main', 'admin_stats', 'admin_metrics', 'admin_settings', 'admin_channels']
+
+# Most MongoDB helpers and Bot API calls one update may cost: handler/outcome -> (db, api).
+# With --budget the run fails if any update goes over. Membership checks are one
+# getChatMember per force-join channel (two here), so api counts grow with channels.
+ROUND_TRIP_BUDGETS = {
+    'start/ok': (2, 4),
+    'video_request/delivered': (2, 5),         # fetch_video, lookup_memberships; + answerCallbackQuery on "Joined"
+    'video_request/force_join': (2, 4),
+    'video_request/not_found': (1, 2),
+    'video_request/repeat': (0, 1),            # same link again inside VIDEO_REPEAT_WINDOW
+    'video_request/coalesced': (0, 0),         # same link while the first is running; answered from it
+    'button_callback/ok': (2, 5),              # verify: answerCallbackQuery + delivery
+    'inline_query/ok': (0, 1),
+    'channel_post/ok': (0, 0),                 # saved by the batcher, off the update path
+    'update/ok': (2, 5),                       # whole update, including calls outside the handlers
+}
+
+# ===================== SETUP =====================
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test the bot against a fake Bot API")
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='mixed')
+    parser.add_argument('--count', type=int, default=2000, help="updates to send")
+    parser.add_argument('--rate', type=float, default=200, help="updates per second")
+    parser.add_argument('--users', type=int, default=500, help="distinct users")
+    parser.add_argument('--videos', type=int, default=1000, help="videos to seed")
+    parser.add_argument('--not-joined', type=float, default=0.2,
+                        help="share of users who have not joined the force-join channels")
+    parser.add_argument('--api-latency', type=float, default=30, help="fake Bot API latency in ms")
+    parser.add_argument('--flood-rate', type=float, default=0,
+                        help="share of sent messages answered with 429 retry_after=1")
+    parser.add_argument('--no-rate-limits', action='store_true',
+                        help="lift the outbound scheduler's Telegram limits")
+    parser.add_argument('--mongo-uri', help="local mongod to use instead of the in-memory fake")
+    parser.add_argument('--allow-remote', action='store_true',
+                        help="allow a --mongo-uri that is not localhost")
+    parser.add_argument('--port', type=int, default=8881, help="port of the fake Bot API")
+    parser.add_argument('--timeout', type=float, default=300, help="seconds to wait for processing")
+    parser.add_argument('--budget', action='store_true',
+                        help="fail if an update goes over ROUND_TRIP_BUDGETS")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="also save the results to this JSON file")
+    return parser.parse_args()
+
+def import_bot(args):
+    """Import the bot module against the chosen MongoDB"""
+    if args.mongo_uri:
+        host = urlsplit(args.mongo_uri).hostname
+        if host not in ('localhost', '127.0.0.1', '::1') and not args.allow_remote:
+            sys.exit(f"❌ Refusing to load test against {host}; use a local mongod or --allow-remote")
+        os.environ["MONGO_URI"] = args.mongo_uri
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("❌ mongomock is not installed (pip install mongomock), or pass --mongo-uri")
+        import pymongo
+        client = mongomock.MongoClient()
+        pymongo.MongoClient = lambda *a, **k: client
+        os.environ["MONGO_URI"] = "mongodb://mongomock"
+
+    import bot_fixed
+    for name in ('bot_fixed', 'httpx', 'telegram'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    return bot_fixed
+
+def seed_database(bot, args, rng):
+    """Start from an empty bot database with videos and force-join channels"""
+    bot.mongo_client.drop_database(bot.db.name)
+    bot.ensure_indexes()
+    bot.initialize_defaults.sync()
+    for channel_id, username in FORCE_JOIN_CHANNELS:
+        bot.add_force_join_channel.sync(channel_id, username)
+
+    videos = [
+        {
+            'channel_id': UPLOAD_CHANNEL_ID,
+            'message_id': message_id,
+            'channel_name': 'Load Test',
+            'caption': ' '.join(rng.choice(CAPTION_WORDS) for _ in range(5)),
+            'media_type': 'video',
+            'file_id': f"FILE{message_id}",
+            'duration': rng.randint(60, 3600),
+        }
+        for message_id in range(1, args.videos + 1)
+    ]
+    codes = []
+    for start in range(0, len(videos), 500):
+        _, saved = bot.save_videos.sync(videos[start:start + 500])
+        codes += [video['code'] for video in saved]
+    return codes
+
+# ===================== FAKE BOT API =====================
+class FakeBotApi:
+    """Answers Bot API methods with canned results after a fixed delay"""
+
+    def __init__(self, bot, args, rng):
+        self.bot = bot
+        self.latency = args.api_latency / 1000
+        self.flood_rate = args.flood_rate
+        self.not_joined = args.not_joined
+        self.rng = rng
+        self.calls = Counter()
+        self.message_ids = iter(range(10 ** 6, 10 ** 9))
+        self.server = bot.HttpServer()
+        self.server.REASONS = {**bot.HttpServer.REASONS, 429: 'Too Many Requests'}
+
+    def user_joined(self, user_id):
+        # Stable per user, so repeated checks give the same answer
+        return (user_id * 2654435761 % 1000) / 1000 >= self.not_joined
+
+    def result(self, method, params):
+        chat_id = int(params.get('chat_id', ADMIN_ID))
+        if method == 'getMe':
+            return {'id': 999999, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'loadtest_bot'}
+        if method == 'getChatMember':
+            user_id = int(params['user_id'])
+            status = 'member' if self.user_joined(user_id) else 'left'
+            return {'status': status, 'user': {'id': user_id, 'is_bot': False, 'first_name': 'U'}}
+        if method == 'copyMessage':
+            return {'message_id': next(self.message_ids)}
+        if method.startswith(('send', 'edit')):
+            return {
+                'message_id': next(self.message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': 'ok'
+            }
+        return True
+
+    async def handle(self, request):
+        method = request.path.rsplit('/', 1)[-1]
+        self.calls[method] += 1
+        params = dict(parse_qsl(request.body.decode())) if request.body else {}
+        if request.headers.get('content-type', '').startswith('application/json'):
+            params = json.loads(request.body)
+
+        await asyncio.sleep(self.latency)
+        if method in ('sendMessage', 'copyMessage') and self.rng.random() < self.flood_rate:
+            self.calls['429'] += 1
+            return self.bot.json_response({
+                'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1}
+            }, 429)
+        return self.bot.json_response({'ok': True, 'result': self.result(method, params)})
+
+    async def start(self, port):
+        # Every request path is /bot<token>/<method>; route the ones the bot uses
+        for method in ('getMe', 'sendMessage', 'copyMessage', 'editMessageText', 'answerCallbackQuery',
+                       'getChatMember', 'sendVideo', 'sendDocument', 'sendAnimation',
+                       'answerInlineQuery', 'deleteWebhook', 'setWebhook', 'logOut', 'close'):
+            self.server.route('POST', f"/bot{self.bot.BOT_TOKEN}/{method}", self.handle)
+        await self.server.start('127.0.0.1', port)
+
+# ===================== TRAFFIC =====================
+class Traffic:
+    """Builds update JSON for each action"""
+
+    def __init__(self, args, codes, rng):
+        self.args = args
+        self.codes = codes
+        self.rng = rng
+        self.update_ids = iter(range(1, 10 ** 9))
+        self.upload_ids = iter(range(args.videos + 1, 10 ** 9))
+        self.album = None
+        self.last_verify = None
+
+    def user(self):
+        user_id = FIRST_USER_ID + self.rng.randrange(self.args.users)
+        return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"}
+
+    def popular_code(self):
+        # A few videos get most of the traffic
+        if self.rng.random() < 0.03:
+            return 'vZZZZZZ'
+        index = min(int(self.rng.paretovariate(1.2)) - 1, len(self.codes) - 1)
+        return self.codes[index]
+
+    def message(self, user, text):
+        entities = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text.startswith('/') else []
+        return {
+            'message_id': self.rng.randrange(1, 10 ** 6),
+            'date': int(time.time()),
+            'chat': {'id': user['id'], 'type': 'private'},
+            'from': user,
+            'text': text,
+            'entities': entities,
+        }
+
+    def callback(self, user, data):
+        return {
+            'id': str(self.rng.randrange(10 ** 12)),
+            'from': user,
+            'chat_instance': 'loadtest',
+            'data': data,
+            'message': {
+                'message_id': self.rng.randrange(1, 10 ** 6),
+                'date': int(time.time()),
+                'chat': {'id': user['id'], 'type': 'private'},
+                'text': 'loadtest',
+            },
+        }
+
+    def deep_link(self, user=None, code=None):
+        return {'message': self.message(user or self.user(), f"/start {code or self.popular_code()}")}
+
+    def verify(self, user=None, code=None):
+        if user is None:
+            # Impatient users tap "Joined" again before the first tap was answered
+            if self.last_verify and self.rng.random() < 0.5:
+                user, code = self.last_verify
+            else:
+                user, code = self.user(), self.popular_code()
+            self.last_verify = (user, code)
+        return {'callback_query': self.callback(user, f"verify_{code}")}
+
+    def inline_query(self, user, text):
+        return {'inline_query': {
+            'id': str(self.rng.randrange(10 ** 12)),
+            'from': user,
+            'query': text,
+            'offset': '',
+        }}
+
+    def inline_search(self):
+        words = ' '.join(self.rng.choice(CAPTION_WORDS) for _ in range(self.rng.randint(1, 2)))
+        cut = self.rng.randint(2, max(2, len(words)))
+        return self.inline_query(self.user(), words[:cut])
+
+    def flood_search(self):
+        # Cheap on CPU (nothing matches), so the run measures waiting, not the search index
+        return self.inline_query({'id': FLOOD_USER_ID, 'is_bot': False, 'first_name': 'Flood'}, 'zzzz')
+
+    def upload(self):
+        # Uploads come in albums of up to 10
+        if not self.album or self.album[1] == 0:
+            self.album = [f"album{self.rng.randrange(10 ** 9)}", self.rng.randint(1, 10)]
+        self.album[1] -= 1
+        message_id = next(self.upload_ids)
+        return {'channel_post': {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': UPLOAD_CHANNEL_ID, 'type': 'channel', 'title': 'Load Test'},
+            'media_group_id': self.album[0],
+            'caption': ' '.join(self.rng.choice(CAPTION_WORDS) for _ in range(5)),
+            'video': {'file_id': f"FILE{message_id}", 'file_unique_id': f"U{message_id}",
+                      'width': 1280, 'height': 720, 'duration': 600},
+        }}
+
+    def admin_panel(self):
+        admin = {'id': ADMIN_ID, 'is_bot': False, 'first_name': 'Admin'}
+        if self.rng.random() < 0.2:
+            return {'message': self.message(admin, '/admin')}
+        return {'callback_query': self.callback(admin, self.rng.choice(ADMIN_CALLBACKS))}
+
+    def next(self, action):
+        update = getattr(self, action)()
+        update['update_id'] = next(self.update_ids)
+        return update
+
+# ===================== REPORT =====================
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(q * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def summarize(samples, duration):
+    """{label: [seconds]} -> {label: count, throughput and latency percentiles in ms}"""
+    summary = {}
+    for label, values in sorted(samples.items()):
+        values = sorted(values)
+        summary[label] = {
+            'count': len(values),
+            'per_second': round(len(values) / duration, 1) if duration else None,
+            'p50_ms': round(percentile(values, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 2),
+            'max_ms': round(values[-1] * 1000, 2),
+        }
+    return summary
+
+def summarize_round_trips(samples):
+    """{label: [RoundTrips]} -> {label: mean/max calls, worst count per helper and method}"""
+    summary = {}
+    for label, trips in sorted(samples.items()):
+        db = [sum(t.db.values()) for t in trips]
+        api = [sum(t.api.values()) for t in trips]
+        helpers, methods = Counter(), Counter()
+        for t in trips:
+            helpers |= t.db
+            methods |= t.api
+        summary[label] = {
+            'count': len(trips),
+            'db_mean': round(sum(db) / len(db), 2),
+            'db_max': max(db),
+            'api_mean': round(sum(api) / len(api), 2),
+            'api_max': max(api),
+            'db_helpers': dict(helpers),
+            'api_methods': dict(methods),
+        }
+    return summary
+
+def check_budgets(round_trips):
+    """Lines for every handler outcome that went over ROUND_TRIP_BUDGETS"""
+    failures = []
+    for label, row in round_trips.items():
+        budget = ROUND_TRIP_BUDGETS.get(label)
+        if budget is None:
+            failures.append(f"{label}: no budget in ROUND_TRIP_BUDGETS")
+            continue
+        db, api = budget
+        if row['db_max'] > db or row['api_max'] > api:
+            failures.append(
+                f"{label}: db {row['db_max']}/{db}, api {row['api_max']}/{api} "
+                f"(db {row['db_helpers']}, api {row['api_methods']})"
+            )
+    return failures
+
+def print_report(results):
+    print(f"\n🧪 {results['scenario']}: {results['processed']}/{results['updates']} updates "
+          f"in {results['duration_s']}s ({results['throughput_per_s']}/s)")
+    for title, key in (("Actions (end to end)", 'actions'), ("Handlers", 'handlers')):
+        print(f"\n{title}:")
+        print(f"  {'name':32} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        for name, row in results[key].items():
+            print(f"  {name:32} {row['count']:>7} {row['p50_ms']:>9} {row['p95_ms']:>9} {row['p99_ms']:>9}")
+    print("\nRound trips per update:")
+    print(f"  {'name':32} {'db mean':>8} {'db max':>7} {'api mean':>9} {'api max':>8}")
+    for name, row in results['round_trips'].items():
+        print(f"  {name:32} {row['db_mean']:>8} {row['db_max']:>7} {row['api_mean']:>9} {row['api_max']:>8}")
+    print(f"\nBot API calls: {dict(results['bot_api_calls'])}")
+
+def check_bystanders(results):
+    """Lines for user_flood runs where the other users waited on the busy one"""
+    row = results['actions'].get('inline_search')
+    if results['scenario'] != 'user_flood' or row is None:
+        return []
+    if row['p95_ms'] > FLOOD_BYSTANDER_P95_MS:
+        return [f"other users: p95 {row['p95_ms']} ms > {FLOOD_BYSTANDER_P95_MS} ms behind one busy user"]
+    return []
+
+# ===================== RUN =====================
+async def run(args):
+    rng = random.Random(args.seed)
+    bot = import_bot(args)
+    from telegram import Update
+    from telegram.ext import Application
+
+    codes = seed_database(bot, args, rng)
+    api = FakeBotApi(bot, args, random.Random(args.seed + 1))
+    await api.start(args.port)
+
+    if args.no_rate_limits:
+        bot.outbound.rates = {group: 100000 for group in bot.outbound.rates}
+        bot.PER_CHAT_RATE = bot.PER_CHAT_BURST = 100000
+
+    application = bot.build_application(
+        Application.builder()
+        .base_url(f"http://127.0.0.1:{args.port}/bot")
+        .base_file_url(f"http://127.0.0.1:{args.port}/file/bot")
+    )
+
+    # Raw handler timings and round trips, alongside the bot's own histograms
+    handler_samples = defaultdict(list)
+    observe = bot.handler_seconds.observe
+    def record_handler(seconds, handler, outcome):
+        handler_samples[f"{handler}/{outcome}"].append(seconds)
+        observe(seconds, handler, outcome)
+    bot.handler_seconds.observe = record_handler
+
+    round_trips = defaultdict(list)
+    record_round_trips = bot.record_round_trips
+    def record_trips(handler, outcome, trips):
+        round_trips[f"{handler}/{outcome}"].append(trips)
+        record_round_trips(handler, outcome, trips)
+    bot.record_round_trips = record_trips
+
+    # End-to-end time per update: from the queue until its handlers finished
+    sent = {}
+    action_samples = defaultdict(list)
+    finished = asyncio.Event()
+    processor = application.update_processor
+    process = processor.do_process_update
+    async def timed_process(update, coroutine):
+        try:
+            await process(update, coroutine)
+        finally:
+            action, queued_at = sent.pop(update.update_id)
+            action_samples[action].append(time.perf_counter() - queued_at)
+            if not sent and traffic_done.is_set():
+                finished.set()
+    processor.do_process_update = timed_process
+
+    traffic = Traffic(args, codes, rng)
+    mix = SCENARIOS[args.scenario]
+    actions = rng.choices(list(mix), weights=list(mix.values()), k=args.count)
+    traffic_done = asyncio.Event()
+
+    async with application:
+        await bot.start_services(application)
+        await application.start()
+
+        started = time.perf_counter()
+        for i, action in enumerate(actions):
+            # Open loop: updates arrive at --rate whether or not the bot keeps up
+            delay = started + i / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            update = Update.de_json(traffic.next(action), application.bot)
+            sent[update.update_id] = (action, time.perf_counter())
+            await application.update_queue.put(update)
+        traffic_done.set()
+        if not sent:
+            finished.set()
+
+        try:
+            await asyncio.wait_for(finished.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ {len(sent)} updates still unprocessed after {args.timeout}s")
+        duration = time.perf_counter() - started
+
+        await application.stop()
+        await bot.stop_services(application)
+    await api.server.stop()
+
+    processed = len(actions) - len(sent)
+    return {
+        'scenario': args.scenario,
+        'started_at': datetime.utcnow().isoformat() + 'Z',
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'mongo_uri')},
+        'database': 'mongod' if args.mongo_uri else 'mongomock',
+        'updates': len(actions),
+        'processed': processed,
+        'duration_s': round(duration, 2),
+        'throughput_per_s': round(processed / duration, 1),
+        'actions': summarize(action_samples, duration),
+        'handlers': summarize(handler_samples, duration),
+        'round_trips': summarize_round_trips(round_trips),
+        'bot_api_calls': dict(api.calls),
+        'outbound': bot.outbound.metrics(),
+    }
+
+def main():
+    args = parse_args()
+    results = asyncio.run(run(args))
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"\n💾 Results saved to {args.output}")
+
+    if args.budget:
+        failures = check_budgets(results['round_trips']) + check_bystanders(results)
+        if failures:
+            print("\n❌ Over budget:")
+            for line in failures:
+                print(f"  {line}")
+            sys.exit(1)
+        print("\n✅ All updates within round-trip budgets")
+
+if __name__ == '__main__':
+    main()
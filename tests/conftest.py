@@ -0,0 +1,125 @@
+"""
+Fixtures for the tests: the bot's Application against the
+load test's fake Bot API and an in-memory MongoDB (mongomock).
+"""
+
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import sys
+from collections import defaultdict
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import loadtest  # noqa: E402  (sets BOT_TOKEN/ADMIN_ID before the bot is imported)
+
+FAKE_API_PORT = 8891
+
+class BotHarness:
+    """Runs updates through the Application one at a time and keeps the
+    round trips each instrumented handler recorded"""
+
+    def __init__(self, bot, application, api, codes, loop):
+        self.bot = bot
+        self.application = application
+        self.api = api
+        self.codes = codes
+        self.loop = loop
+        self.traffic = loadtest.Traffic(argparse.Namespace(users=1, videos=len(codes)), codes, random.Random(1))
+        self.round_trips = defaultdict(list)
+        self.user_ids = itertools.count(loadtest.FIRST_USER_ID + 10 ** 6)
+        self.upload_ids = itertools.count(10 ** 6)
+        self.update_ids = itertools.count(1)
+
+    def user(self, joined=True):
+        """A user the bot has never seen, in both force-join channels or in neither"""
+        while True:
+            user_id = next(self.user_ids)
+            if self.api.user_joined(user_id) == joined:
+                return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"}
+
+    def admin(self):
+        return {'id': loadtest.ADMIN_ID, 'is_bot': False, 'first_name': 'Admin'}
+
+    def update(self, data):
+        from telegram import Update
+        data['update_id'] = next(self.update_ids)
+        return Update.de_json(data, self.application.bot)
+
+    def message(self, user, text):
+        return self.update({'message': self.traffic.message(user, text)})
+
+    def callback(self, user, data):
+        return self.update({'callback_query': self.traffic.callback(user, data)})
+
+    def deep_link(self, user, code):
+        return self.update(self.traffic.deep_link(user, code))
+
+    def verify(self, user, code):
+        return self.update(self.traffic.verify(user, code))
+
+    def channel_post(self):
+        """A new single-video upload in the upload channel"""
+        message_id = next(self.upload_ids)
+        return self.update({'channel_post': {
+            'message_id': message_id,
+            'date': 0,
+            'chat': {'id': loadtest.UPLOAD_CHANNEL_ID, 'type': 'channel', 'title': 'Load Test'},
+            'caption': 'movie drama',
+            'video': {'file_id': f"FILE{message_id}", 'file_unique_id': f"U{message_id}",
+                      'width': 1280, 'height': 720, 'duration': 600},
+        }})
+
+    def process(self, update):
+        """Handle one update and wait for it"""
+        self.loop.run_until_complete(self.application.process_update(update))
+
+    def trips(self, update, label):
+        """Handle one update; its only round trips recorded under `label`"""
+        seen = len(self.round_trips[label])
+        self.process(update)
+        recorded = self.round_trips[label][seen:]
+        assert len(recorded) == 1, f"{label}: {len(recorded)} records"
+        return dict(recorded[0].db), dict(recorded[0].api)
+
+@pytest.fixture(scope='session')
+def harness():
+    args = argparse.Namespace(
+        mongo_uri=None, allow_remote=False, videos=50, users=1,
+        api_latency=0, flood_rate=0, not_joined=0.5
+    )
+    bot = loadtest.import_bot(args)
+    from telegram.ext import Application
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    codes = loadtest.seed_database(bot, args, random.Random(1))
+    api = loadtest.FakeBotApi(bot, args, random.Random(2))
+    loop.run_until_complete(api.start(FAKE_API_PORT))
+
+    # Exact counts, not pacing, are under test
+    bot.outbound.rates = {group: 100000 for group in bot.outbound.rates}
+    bot.PER_CHAT_RATE = bot.PER_CHAT_BURST = 100000
+    application = bot.build_application(
+        Application.builder()
+        .base_url(f"http://127.0.0.1:{FAKE_API_PORT}/bot")
+        .base_file_url(f"http://127.0.0.1:{FAKE_API_PORT}/file/bot")
+    )
+    harness = BotHarness(bot, application, api, codes, loop)
+
+    record_round_trips = bot.record_round_trips
+    def record(handler, outcome, trips):
+        harness.round_trips[f"{handler}/{outcome}"].append(trips)
+        record_round_trips(handler, outcome, trips)
+    bot.record_round_trips = record
+
+    loop.run_until_complete(application.initialize())
+    loop.run_until_complete(bot.start_services(application))
+    yield harness
+    loop.run_until_complete(bot.stop_services(application))
+    loop.run_until_complete(application.shutdown())
+    loop.run_until_complete(api.server.stop())
+    loop.close()
@@ -0,0 +1,173 @@
+"""
+MongoDB helper calls and Bot API calls per handler path.
+
+Each case prepares a fresh update (and warms caches where the path needs
+it), then benchmarks the handler and checks that every round made exactly
+the calls listed. A change that adds a round trip fails here.
+
+    pip install -r requirements-dev.txt
+    pytest tests
+"""
+
+import pytest
+
+ROUNDS = 20
+
+def run_case(benchmark, harness, prepare, label, expected_db, expected_api):
+    results = []
+
+    def setup():
+        return (prepare(),), {}
+
+    def handle(update):
+        results.append(harness.trips(update, label))
+
+    benchmark.pedantic(handle, setup=setup, rounds=ROUNDS)
+    assert results
+    for db, api in results:
+        assert db == expected_db
+        assert api == expected_api
+
+# ===================== START =====================
+def test_start_welcome(benchmark, harness):
+    run_case(
+        benchmark, harness,
+        lambda: harness.message(harness.user(), '/start'),
+        'start/ok', {}, {'sendMessage': 1}
+    )
+
+# ===================== VIDEO REQUESTS =====================
+def test_deep_link_nothing_cached(benchmark, harness):
+    codes = iter(harness.codes)
+
+    def prepare():
+        code = next(codes)
+        harness.bot.video_cache.pop(code)
+        return harness.deep_link(harness.user(), code)
+
+    run_case(
+        benchmark, harness, prepare, 'video_request/delivered',
+        {'fetch_video': 1, 'lookup_memberships': 1},
+        {'getChatMember': 2, 'copyMessage': 1, 'sendMessage': 1}
+    )
+
+def test_deep_link_membership_cached(benchmark, harness):
+    codes = iter(harness.codes[20:])
+
+    def prepare():
+        user = harness.user()
+        harness.process(harness.deep_link(user, harness.codes[0]))
+        code = next(codes)
+        harness.bot.video_cache.pop(code)
+        return harness.deep_link(user, code)
+
+    run_case(
+        benchmark, harness, prepare, 'video_request/delivered',
+        {'fetch_video': 1}, {'copyMessage': 1, 'sendMessage': 1}
+    )
+
+def test_deep_link_video_cached(benchmark, harness):
+    code = harness.codes[0]
+    harness.process(harness.deep_link(harness.user(), code))
+
+    run_case(
+        benchmark, harness,
+        lambda: harness.deep_link(harness.user(), code),
+        'video_request/delivered',
+        {'lookup_memberships': 1}, {'getChatMember': 2, 'copyMessage': 1, 'sendMessage': 1}
+    )
+
+def test_deep_link_all_cached(benchmark, harness):
+    code = harness.codes[0]
+
+    def prepare():
+        user = harness.user()
+        harness.process(harness.deep_link(user, code))
+        harness.bot.recent_video_requests.pop((user['id'], code))
+        return harness.deep_link(user, code)
+
+    run_case(
+        benchmark, harness, prepare, 'video_request/delivered',
+        {}, {'copyMessage': 1, 'sendMessage': 1}
+    )
+
+def test_deep_link_repeat(benchmark, harness):
+    code = harness.codes[1]
+
+    def prepare():
+        user = harness.user()
+        harness.process(harness.deep_link(user, code))
+        return harness.deep_link(user, code)
+
+    run_case(benchmark, harness, prepare, 'video_request/repeat', {}, {'sendMessage': 1})
+
+def test_deep_link_force_join(benchmark, harness):
+    code = harness.codes[2]
+    harness.process(harness.deep_link(harness.user(), code))
+
+    run_case(
+        benchmark, harness,
+        lambda: harness.deep_link(harness.user(joined=False), code),
+        'video_request/force_join',
+        {'lookup_memberships': 1}, {'getChatMember': 2, 'sendMessage': 1}
+    )
+
+def test_deep_link_unknown_code(benchmark, harness):
+    def prepare():
+        harness.bot.video_cache.pop('vZZZZZZ')
+        return harness.deep_link(harness.user(), 'vZZZZZZ')
+
+    run_case(benchmark, harness, prepare, 'video_request/not_found', {'fetch_video': 1}, {'sendMessage': 1})
+
+def test_deep_link_known_missing(benchmark, harness):
+    harness.process(harness.deep_link(harness.user(), 'vZZZZZZ'))
+
+    run_case(
+        benchmark, harness,
+        lambda: harness.deep_link(harness.user(), 'vZZZZZZ'),
+        'video_request/not_found', {}, {'sendMessage': 1}
+    )
+
+# ===================== CALLBACKS =====================
+def test_joined_tap_inside_repeat_window(benchmark, harness):
+    code = harness.codes[3]
+
+    def prepare():
+        user = harness.user(joined=False)
+        harness.process(harness.deep_link(user, code))
+        return harness.verify(user, code)
+
+    run_case(benchmark, harness, prepare, 'video_request/repeat', {}, {'answerCallbackQuery': 1})
+
+def test_joined_tap_still_not_joined(benchmark, harness):
+    code = harness.codes[3]
+
+    def prepare():
+        user = harness.user(joined=False)
+        harness.process(harness.deep_link(user, code))
+        harness.bot.recent_video_requests.pop((user['id'], code))
+        return harness.verify(user, code)
+
+    run_case(
+        benchmark, harness, prepare, 'button_callback/ok',
+        {'lookup_memberships': 1}, {'answerCallbackQuery': 1, 'getChatMember': 2, 'sendMessage': 1}
+    )
+
+def test_help_button(benchmark, harness):
+    run_case(
+        benchmark, harness,
+        lambda: harness.callback(harness.user(), 'help'),
+        'button_callback/ok', {}, {'answerCallbackQuery': 1, 'sendMessage': 1}
+    )
+
+@pytest.mark.parametrize('data', ['admin_main', 'admin_stats', 'admin_settings', 'admin_channels'])
+def test_admin_panel(benchmark, harness, data):
+    run_case(
+        benchmark, harness,
+        lambda: harness.callback(harness.admin(), data),
+        'button_callback/ok', {}, {'answerCallbackQuery': 1, 'editMessageText': 1}
+    )
+
+# ===================== CHANNEL POSTS =====================
+def test_channel_post(benchmark, harness):
+    run_case(benchmark, harness, harness.channel_post, 'channel_post/ok', {}, {})
@@ -0,0 +1,86 @@
+"""
+CONCURRENT_UPDATES slots while Bot API calls wait on the outbound scheduler.
+"""
+
+import asyncio
+
+def run(harness, coroutine):
+    return harness.loop.run_until_complete(asyncio.wait_for(coroutine, 5))
+
+def test_slot_given_back_while_waiting(harness):
+    bot = harness.bot
+    slots = bot.UpdateSlots(1)
+    turn = asyncio.Event()
+    finished = []
+
+    async def waiting_update():
+        async with bot.UpdateSlot(slots) as slot:
+            await slot.released_while(turn.wait())
+            finished.append('waiting')
+
+    async def other_update():
+        async with bot.UpdateSlot(slots):
+            finished.append('other')
+
+    async def scenario():
+        waiting = asyncio.create_task(waiting_update())
+        await asyncio.sleep(0)
+        await other_update()
+        turn.set()
+        await waiting
+
+    run(harness, scenario())
+    assert finished == ['other', 'waiting']
+    assert slots.free == 1
+
+def test_returning_update_goes_first(harness):
+    bot = harness.bot
+    slots = bot.UpdateSlots(1)
+    turn = asyncio.Event()
+    finished = []
+
+    async def waiting_update():
+        async with bot.UpdateSlot(slots) as slot:
+            await slot.released_while(turn.wait())
+            finished.append('returning')
+
+    async def new_update(name):
+        async with bot.UpdateSlot(slots):
+            await asyncio.sleep(0.01)
+            finished.append(name)
+
+    async def scenario():
+        waiting = asyncio.create_task(waiting_update())
+        await asyncio.sleep(0)
+        first = asyncio.create_task(new_update('first'))
+        await asyncio.sleep(0)
+        turn.set()
+        second = asyncio.create_task(new_update('second'))
+        await asyncio.gather(waiting, first, second)
+
+    run(harness, scenario())
+    assert finished == ['first', 'returning', 'second']
+    assert slots.free == 1
+
+def test_concurrent_calls_share_the_slot(harness):
+    bot = harness.bot
+    slots = bot.UpdateSlots(1)
+    turns = [asyncio.Event(), asyncio.Event()]
+
+    async def update():
+        async with bot.UpdateSlot(slots) as slot:
+            await asyncio.gather(*(slot.released_while(turn.wait()) for turn in turns))
+            assert slot.held
+
+    async def scenario():
+        task = asyncio.create_task(update())
+        await asyncio.sleep(0.01)
+        assert slots.free == 1
+        turns[0].set()
+        await asyncio.sleep(0.01)
+        assert slots.free == 1
+        turns[1].set()
+        await task
+
+    run(harness, scenario())
+    assert slots.free == 1